@@ -7,18 +7,27 @@ from pathlib import Path
 import threading
 import time
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent
 import mimetypes
 import shutil
 import requests
+import peer_client
+import multicast
+from relay import split_relay_peers
+from transfer_queue import TransferQueue
+from peer_registry import get_peer_registry, sync_active_connections
+from discovery import get_discovery_service, PRESENCE_VERSION, PRESENCE_MAX_AGE, PEER_REVALIDATE_INTERVAL
 import json
 from datetime import datetime
 import queue
-import ipaddress
+from collections import deque
 import concurrent.futures
 import logging
 import sys
 import site
+import tarfile
+from urllib.parse import quote
+from email.message import Message
 
 # Version compatibility check
 PYTHON_VERSION = sys.version_info
@@ -33,20 +42,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# zstd compression for folder tar streams is optional
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
 # Constants
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_UPLOAD_FOLDER = os.path.join(PROJECT_ROOT, "downloads")
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200MB max file size
 STREAMLIT_PORT = 8501
 FLASK_PORT = 8502
-BROADCAST_INTERVAL = 10
-EVENT_FILE = "file_events.json"
+TRANSFER_MODES = ['stream', 'resumable', 'striped', 'tar', 'batch', 'relay', 'multicast'] + (['zstd'] if ZSTD_AVAILABLE else [])
+RESUMABLE_UPLOAD_THRESHOLD = 16 * 1024 * 1024  # Files this big go through resumable upload sessions
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB per upload session chunk
+RESUMABLE_MAX_RETRIES = 5  # Consecutive failed chunks before giving up
+RESUMABLE_REQUEST_TIMEOUT = 30  # Seconds
+DOWNLOAD_SEGMENTS = 4  # Parallel Range requests per segmented download
+SEGMENTED_DOWNLOAD_MIN_SIZE = 32 * 1024 * 1024  # Smaller files are fetched in one stream
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB reads from download responses
+TAR_STREAM_COMPRESSION = 'zstd' if ZSTD_AVAILABLE else 'none'  # How folders are packed for sending
+TAR_STREAM_BUFFER_SIZE = 1024 * 1024  # tarfile write buffer, also the upload chunk size
+TAR_STREAM_QUEUE_SIZE = 8  # Chunks buffered between the tar packer and the upload
 CONFIG_FILE = "app_config.json"
+TRANSFER_QUEUE_DB = os.path.join(PROJECT_ROOT, "transfer_queue.db")  # Outbound sends waiting or retrying
+TRANSFER_QUEUE_WORKERS = 2  # Files sent at once from the queue, override with transfer_queue_workers
+EVENT_CONSUMER = "streamlit"  # Cursor name this app consumes the Flask event journal under
+EVENT_WAIT_TIMEOUT = 25  # Seconds each event long-poll stays open
+EVENT_BUFFER_SIZE = 1000  # Recent events kept in memory for sessions to catch up on
+FANOUT_WORKERS = 8  # Peers sent to at once, override with fanout_workers in app_config.json
+PEER_CHECK_TIMEOUT = 5  # Seconds to wait for a peer's downloads_enabled answer
+PEER_SEND_TIMEOUT = 15 * 60  # Seconds one peer may take before its transfer is cancelled
+PEER_REQUEST_TIMEOUT = (5, 60)  # Connect and read timeouts for single-request sends
+RELAY_MIN_PEERS = 8  # Broadcasts to this many peers go down a relay tree, override with relay_min_peers
+RELAY_SEEDS = 3  # Peers the sender uploads to itself in relay mode, override with relay_seeds
+RELAY_REQUEST_TIMEOUT = (5, PEER_SEND_TIMEOUT)  # A seed only answers once its whole subtree is done
+TEE_CHUNK_SIZE = 1024 * 1024  # Shared read size when broadcasting files below the resumable threshold
+TEE_QUEUE_DEPTH = 4  # Chunks a receiver may fall behind the shared broadcast read before it waits
+STRIPED_UPLOAD_THRESHOLD = 64 * 1024 * 1024  # Single-peer sends this big go over several connections
+STRIPE_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes per striped chunk request
+STRIPE_MIN = 2  # Connections a striped upload starts with
+STRIPE_MAX = 8  # Most connections a striped upload grows to
+STRIPE_SAMPLE_INTERVAL = 2  # Seconds of throughput measured before the stripe count changes
+STRIPE_GAIN = 0.1  # Throughput change that counts as better or worse when adapting the stripe count
+SMALL_FILE_BATCH_MAX_SIZE = 1024 * 1024  # Files up to this size can be batched into one transfer
+SMALL_FILE_BATCH_MIN_FILES = 8  # Sends of at least this many small files go out as one batch
 
 # Create a thread-safe queue for communication
-connection_queue = queue.Queue()
 file_event_queue = queue.Queue()
 
+# Peers that answered 404 on /upload_stream and need the multipart fallback
+legacy_upload_peers = set()
+
+# Stripe count each peer's last striped upload settled on
+peer_stripe_counts = {}
+
 # Compatibility layer for different Python versions
 def create_thread(target, daemon=True):
     """Create a thread with version-specific handling."""
@@ -223,8 +275,6 @@ if 'last_received_file' not in st.session_state:
     st.session_state.last_received_file = None
 if 'current_session_files' not in st.session_state:
     st.session_state.current_session_files = set()
-if 'background_threads_started' not in st.session_state:
-    st.session_state.background_threads_started = False
 if 'last_upload_status' not in st.session_state:
     st.session_state.last_upload_status = None
 if 'last_upload_time' not in st.session_state:
@@ -261,13 +311,68 @@ def find_3ds_max():
     logger.error("3ds Max installation not found. Please configure the path in the Connected Devices section.")
     return None
 
-def check_file_events():
-    """Check for new file events."""
+class FileEventSubscriber:
+    """Long-polls the Flask event journal once per process and buffers the events."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=EVENT_BUFFER_SIZE)
+        self.latest_seq = 0
+        self.claimed_seq = 0
+        self.thread = create_thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        """Keep a long-poll open on /events/wait and collect what it returns."""
+        while True:
+            try:
+                response = peer_client.get(
+                    f"http://localhost:{FLASK_PORT}/events/wait",
+                    params={'consumer': EVENT_CONSUMER, 'timeout': EVENT_WAIT_TIMEOUT},
+                    timeout=EVENT_WAIT_TIMEOUT + 5
+                )
+                response.raise_for_status()
+                events = response.json().get('events', [])
+                if events:
+                    with self.condition:
+                        self.events.extend(events)
+                        self.latest_seq = events[-1]['seq']
+                        self.condition.notify_all()
+            except Exception as e:
+                # Flask server not up yet or restarting
+                logger.debug(f"Event subscription error: {str(e)}")
+                time.sleep(2)
+
+    def events_since(self, seq):
+        """Get the buffered events after seq."""
+        with self.condition:
+            return [event for event in self.events if event['seq'] > seq]
+
+    def claim(self, events):
+        """Claim events for handling, returning the ones no other session has claimed."""
+        with self.condition:
+            claimed = [event for event in events if event['seq'] > self.claimed_seq]
+            if claimed:
+                self.claimed_seq = claimed[-1]['seq']
+            return claimed
+
+@st.cache_resource
+def get_file_event_subscriber():
+    """Get the file event subscriber shared by every session in this process."""
+    return FileEventSubscriber()
+
+def check_file_events(auto_open_enabled=True):
+    """Check for new file events, opening received files if auto_open_enabled."""
     try:
-        # Get events from Flask server
-        response = requests.get(f"http://localhost:{FLASK_PORT}/check_events")
-        if response.status_code == 200:
-            events = response.json().get('events', [])
+        # Events arrive through the process-wide subscriber, no request per rerun
+        subscriber = get_file_event_subscriber()
+        if 'event_cursor' not in st.session_state:
+            # Start at the events nobody has handled yet
+            st.session_state.event_cursor = subscriber.claimed_seq
+        events = subscriber.events_since(st.session_state.event_cursor)
+        if events:
+            st.session_state.event_cursor = events[-1]['seq']
+            # Every session shows new files, but only one opens or runs them
+            claimed_seqs = {event['seq'] for event in subscriber.claim(events)}
             logger.info(f"Received events from Flask: {events}")
             print(f"Received events from Flask: {events}")
             
@@ -311,7 +416,9 @@ def check_file_events():
                     
                     # Handle file based on type
                     file_path = os.path.join(UPLOAD_FOLDER, filename)
-                    if os.path.exists(file_path):
+                    if event['seq'] not in claimed_seqs:
+                        logger.info(f"{filename} was already handled by another session")
+                    elif os.path.exists(file_path):
                         if is_script:
                             logger.info(f"Processing script file: {filename}")
                             # For .ms files, execute directly without opening
@@ -484,7 +591,7 @@ read
                                     # For other script types, use the default handler
                                     logger.info(f"Using default handler for script: {filename}")
                                     open_file_with_default_app(file_path)
-                        elif not is_zip_event and not has_script_files and st.session_state.get('auto_open_enabled', True):
+                        elif not is_zip_event and not has_script_files and auto_open_enabled:
                             # Only auto-open non-script files if:
                             # 1. Not from a zip file
                             # 2. No script files were transferred
@@ -493,30 +600,785 @@ read
                     else:
                         logger.error(f"File not found: {file_path}")
                         print(f"File not found: {file_path}")
-                    
-                    # Force rerun to update the UI
-                    st.rerun()
+                elif event['type'] == 'files_received':
+                    # A batch of small files gets one notification, and isn't auto-opened
+                    filenames = event.get('filenames', [])
+                    if filenames:
+                        st.session_state.last_received_file = filenames[-1]
+                    st.session_state.last_upload_status = {
+                        'success': f"{len(filenames)} files received successfully"
+                    }
+                    st.session_state.last_upload_time = datetime.now()
+                    st.success(f"📥 {len(filenames)} new files received")
+                    st.toast(f"📥 {len(filenames)} new files received")
+            
+            # Force rerun to update the UI
+            st.rerun()
             
     except Exception as e:
         logger.error(f"Error checking file events: {str(e)}")
         print(f"Error checking file events: {str(e)}")
 
-def send_file_to_device(file_path, device_ip):
-    """Send a file to a specific device using the Flask server."""
+class MemoryFile:
+    """Read-only file over a buffer that hands out memoryview slices instead of copies."""
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        data = self.view[self.position:end]
+        self.position = end
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class UploadBuffer:
+    """A file to send straight from memory, such as a Streamlit upload, without saving it first."""
+    def __init__(self, name, buffer):
+        self.name = os.path.basename(name)
+        self.buffer = buffer
+        self.size = len(memoryview(buffer).cast('B'))
+
+    def open(self):
+        return MemoryFile(self.buffer)
+
+    def __str__(self):
+        return self.name
+
+class FileBatch:
+    """Many small files sent as one tar stream, so each peer gets one request for all of them."""
+    def __init__(self, files):
+        self.files = files  # (name on the peer, file path or UploadBuffer) pairs
+        self.name = f"{len(files)} files"
+        self.size = sum(source_size(file_path) for _, file_path in files)
+
+    def __str__(self):
+        return self.name
+
+def source_name(file_path):
+    """Filename a send of file_path arrives under on the peer."""
+    return os.path.basename(file_path) if isinstance(file_path, str) else file_path.name
+
+def source_size(file_path):
+    return os.path.getsize(file_path) if isinstance(file_path, str) else file_path.size
+
+def open_source(file_path):
+    """Open a file path or an UploadBuffer for reading."""
+    return file_path.open() if isinstance(file_path, UploadBuffer) else open(file_path, 'rb')
+
+def is_folder(file_path):
+    return isinstance(file_path, str) and os.path.isdir(file_path)
+
+def is_packed(file_path):
+    """Folders and file batches go out as a single tar stream."""
+    return isinstance(file_path, FileBatch) or is_folder(file_path)
+
+def send_file_to_device(file_path, device_ip, progress=None, cancelled=None, chunks=None):
+    """Send a file to a specific device using the Flask server.
+    
+    file_path may also be an UploadBuffer, which is sent from memory.
+    progress is called with the number of bytes sent so far, and setting the
+    cancelled event aborts the transfer at the next chunk. chunks is an
+    optional branch of a BroadcastTee to send from instead of reading the
+    file again.
+    """
+    if is_packed(file_path):
+        return send_folder_tar(file_path, device_ip, progress=progress, cancelled=cancelled, chunks=chunks)
+    if device_ip in legacy_upload_peers:
+        if chunks is not None:
+            chunks.close()
+        return send_file_multipart(file_path, device_ip, progress=progress)
+    # Sends sharing a broadcast read go at its pace, striping only pays off on its own
+    if (chunks is None and source_size(file_path) >= STRIPED_UPLOAD_THRESHOLD
+            and load_config().get('striped_uploads', True)):
+        return send_file_striped(file_path, device_ip, progress=progress, cancelled=cancelled)
+    if source_size(file_path) >= RESUMABLE_UPLOAD_THRESHOLD:
+        return send_file_resumable(file_path, device_ip, progress=progress, cancelled=cancelled, chunks=chunks)
+    return send_file_stream(file_path, device_ip, progress=progress, cancelled=cancelled, chunks=chunks)
+
+def iter_file_chunks(file_path, chunk_size):
+    """Yield (offset, chunk) pairs covering a file."""
+    with open_source(file_path) as f:
+        offset = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield offset, chunk
+            offset += len(chunk)
+
+def number_chunks(chunks):
+    """Turn a plain chunk stream into (offset, chunk) pairs."""
+    offset = 0
+    try:
+        for chunk in chunks:
+            yield offset, chunk
+            offset += len(chunk)
+    finally:
+        chunks.close()
+
+def open_broadcast_source(file_path):
+    """The (offset, chunk) stream a broadcast of file_path shares between receivers."""
+    if is_packed(file_path):
+        return number_chunks(iter_folder_tar(file_path, TAR_STREAM_COMPRESSION))
+    if source_size(file_path) >= RESUMABLE_UPLOAD_THRESHOLD:
+        # Match the upload session chunks so each one goes out as a single PUT
+        return iter_file_chunks(file_path, RESUMABLE_CHUNK_SIZE)
+    return iter_file_chunks(file_path, TEE_CHUNK_SIZE)
+
+class BroadcastTee:
+    """Reads a source once and hands every chunk to each attached receiver.
+    
+    The source yields (offset, chunk) pairs and is only read once the first
+    receiver asks for data. Every receiver has a bounded queue, so the shared
+    read runs at the pace of the slowest receiver still attached; receivers
+    that finish, fail or fall back to their own read must detach.
+    """
+    def __init__(self, source, receivers, depth=TEE_QUEUE_DEPTH):
+        self.source = source
+        self.queues = {receiver: queue.Queue(maxsize=depth) for receiver in receivers}
+        self.detached = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = create_thread(target=self.pump)
+                self.thread.start()
+
+    def pump(self):
+        try:
+            for item in self.source:
+                if not self.put_all(item):
+                    # Nobody is listening any more
+                    return
+            self.put_all(None)
+        except Exception as e:
+            self.put_all(e)
+        finally:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+
+    def put_all(self, item):
+        """Queue an item for every attached receiver; False once all have detached."""
+        for receiver, chunks in self.queues.items():
+            while receiver not in self.detached:
+                try:
+                    chunks.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+        return len(self.detached) < len(self.queues)
+
+    def branch(self, receiver, cancelled=None):
+        """Yield the (offset, chunk) pairs for one receiver."""
+        self.start()
+        chunks = self.queues[receiver]
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=0.5)
+                except queue.Empty:
+                    if cancelled is not None and cancelled.is_set():
+                        raise IOError("Upload was cancelled")
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.detach(receiver)
+
+    def detach(self, receiver):
+        """Stop feeding a receiver and free whatever it still had queued."""
+        self.detached.add(receiver)
+        chunks = self.queues[receiver]
+        while True:
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                break
+
+class ChunkReader:
+    """File-like reader over an (offset, chunk) stream."""
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def read(self, size=-1):
+        # Hands out whole chunks, which is all http.client needs
+        for _, chunk in self.chunks:
+            return chunk
+        return b''
+
+class ProgressReader:
+    """Read-only file wrapper that reports upload progress and honours cancellation."""
+    def __init__(self, f, size, progress=None, cancelled=None):
+        self.f = f
+        self.size = size
+        self.progress = progress
+        self.cancelled = cancelled
+        self.sent = 0
+
+    def read(self, size=-1):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise IOError("Upload was cancelled")
+        data = self.f.read(size)
+        self.sent += len(data)
+        if self.progress:
+            self.progress(self.sent)
+        return data
+
+    def __len__(self):
+        return self.size
+
+def send_file_stream(file_path, device_ip, progress=None, cancelled=None, chunks=None):
+    """Send a file to a device as a single streamed request body."""
+    try:
+        # Stream the raw file body so neither side buffers or re-copies it
+        url = f"http://{device_ip}:{FLASK_PORT}/upload_stream/{quote(source_name(file_path))}"
+        file_size = source_size(file_path)
+        with open_source(file_path) as f:
+            source = f if chunks is None else ChunkReader(chunks)
+            response = peer_client.put(
+                url,
+                data=ProgressReader(source, file_size, progress, cancelled),
+                headers={
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Length': str(file_size)
+                },
+                timeout=PEER_REQUEST_TIMEOUT
+            )
+        if response.status_code == 404:
+            # Older peers only know the multipart /upload endpoint
+            legacy_upload_peers.add(device_ip)
+            if chunks is not None:
+                chunks.close()
+            return send_file_multipart(file_path, device_ip, progress=progress)
+        if response.status_code == 200:
+            return True
+        else:
+            logger.error(f"Failed to send file to {device_ip}: {response.text}")
+            return False
+    except Exception as e:
+        logger.error(f"Error sending file to {device_ip}: {str(e)}")
+        return False
+
+def get_upload_session_offset(session_url):
+    """Ask the receiver how many bytes of an upload session it has committed."""
+    response = peer_client.get(session_url, timeout=RESUMABLE_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['offset']
+
+def next_upload_chunk(f, offset, chunks=None):
+    """The chunk holding offset, taken from the shared broadcast read when it lines up."""
+    if chunks is not None:
+        for chunk_start, chunk in chunks:
+            if chunk_start + len(chunk) > offset:
+                if chunk_start <= offset:
+                    return chunk_start, chunk
+                break
+    # Not broadcasting, or the receiver rewound behind the shared read
+    f.seek(offset)
+    return offset, f.read(RESUMABLE_CHUNK_SIZE)
+
+def send_file_resumable(file_path, device_ip, progress=None, cancelled=None, chunks=None):
+    """Send a file in chunks through an upload session, resuming after dropped connections."""
+    base_url = f"http://{device_ip}:{FLASK_PORT}/upload_session"
+    file_size = source_size(file_path)
+    try:
+        response = peer_client.post(
+            base_url,
+            json={'filename': source_name(file_path), 'size': file_size},
+            timeout=RESUMABLE_REQUEST_TIMEOUT
+        )
+        if response.status_code == 404:
+            # Receiver predates upload sessions, send it in one go instead
+            return send_file_stream(file_path, device_ip, progress=progress, cancelled=cancelled, chunks=chunks)
+        if response.status_code != 201:
+            logger.error(f"Failed to send file to {device_ip}: {response.text}")
+            return False
+        session_url = f"{base_url}/{response.json()['session_id']}"
+        
+        offset = 0
+        failures = 0
+        chunk_start, chunk = 0, b''
+        with open_source(file_path) as f:
+            while offset < file_size:
+                if cancelled is not None and cancelled.is_set():
+                    # Drop the half-written session on the receiver
+                    peer_client.delete(session_url, timeout=PEER_CHECK_TIMEOUT)
+                    logger.warning(f"Upload of {file_path} to {device_ip} was cancelled")
+                    return False
+                if not chunk_start <= offset < chunk_start + len(chunk):
+                    chunk_start, chunk = next_upload_chunk(f, offset, chunks)
+                try:
+                    response = peer_client.put(
+                        session_url,
+                        params={'offset': offset},
+                        data=chunk[offset - chunk_start:],
+                        headers={'Content-Type': 'application/octet-stream'},
+                        timeout=RESUMABLE_REQUEST_TIMEOUT
+                    )
+                    if response.status_code in (200, 409) and 'offset' in response.json():
+                        # On 409 the receiver tells us where it actually is
+                        offset = response.json()['offset']
+                        failures = 0
+                        if progress:
+                            progress(offset)
+                        continue
+                    response.raise_for_status()
+                except requests.RequestException as e:
+                    failures += 1
+                    if failures > RESUMABLE_MAX_RETRIES:
+                        raise
+                    delay = min(2 ** failures, 30)
+                    logger.warning(f"Chunk upload to {device_ip} failed ({str(e)}), retrying in {delay}s...")
+                    time.sleep(delay)
+                    # Pick up from whatever the receiver managed to commit
+                    try:
+                        offset = get_upload_session_offset(session_url)
+                    except requests.RequestException:
+                        pass
+        
+        response = peer_client.post(f"{session_url}/finalize", timeout=RESUMABLE_REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            return True
+        else:
+            logger.error(f"Failed to send file to {device_ip}: {response.text}")
+            return False
+    except Exception as e:
+        logger.error(f"Error sending file to {device_ip}: {str(e)}")
+        return False
+
+def send_file_striped(file_path, device_ip, progress=None, cancelled=None):
+    """Send a file as chunks spread over several connections to a striped upload session.
+    
+    The upload starts with the stripe count the last striped send to this
+    peer settled on. After every STRIPE_SAMPLE_INTERVAL it adds a stripe
+    while that still raises the throughput, and drops one when throughput
+    falls. Failed chunks go back on the queue for any stripe to retry.
+    """
+    base_url = f"http://{device_ip}:{FLASK_PORT}/upload_session"
+    file_size = source_size(file_path)
+    session_url = None
+    try:
+        response = peer_client.post(
+            base_url,
+            json={'filename': source_name(file_path), 'size': file_size, 'striped': True},
+            timeout=RESUMABLE_REQUEST_TIMEOUT
+        )
+        if response.status_code == 404:
+            # Receiver predates upload sessions, send it in one go instead
+            return send_file_stream(file_path, device_ip, progress=progress, cancelled=cancelled)
+        if response.status_code != 201:
+            logger.error(f"Failed to send file to {device_ip}: {response.text}")
+            return False
+        session_url = f"{base_url}/{response.json()['session_id']}"
+        if not response.json().get('striped'):
+            # Receiver only takes chunks in order, use the sequential session instead
+            peer_client.delete(session_url, timeout=PEER_CHECK_TIMEOUT)
+            return send_file_resumable(file_path, device_ip, progress=progress, cancelled=cancelled)
+        
+        ranges = deque(
+            (offset, min(STRIPE_CHUNK_SIZE, file_size - offset))
+            for offset in range(0, file_size, STRIPE_CHUNK_SIZE)
+        )
+        state = {
+            'target': peer_stripe_counts.get(device_ip, STRIPE_MIN),
+            'active': 0,
+            'sent': 0,
+            'done': 0,
+            'outstanding': len(ranges),
+            'failures': 0,
+            'error': None,
+            'complete': False
+        }
+        condition = threading.Condition()
+        
+        def stripe():
+            with open_source(file_path) as f:
+                while True:
+                    with condition:
+                        # Stripes beyond the current target wait here until it grows
+                        while (state['error'] is None and state['outstanding']
+                               and (not ranges or state['active'] >= state['target'])):
+                            condition.wait(0.5)
+                        if state['error'] is not None or not state['outstanding']:
+                            return
+                        offset, length = ranges.popleft()
+                        state['active'] += 1
+                    failure = None
+                    fatal = False
+                    complete = False
+                    try:
+                        f.seek(offset)
+                        response = peer_client.put(
+                            session_url,
+                            params={'offset': offset},
+                            data=f.read(length),
+                            headers={'Content-Type': 'application/octet-stream'},
+                            timeout=RESUMABLE_REQUEST_TIMEOUT
+                        )
+                        if response.status_code == 404 and state['complete']:
+                            # The receiver committed the file and forgot the session, nothing is missing
+                            pass
+                        elif 400 <= response.status_code < 500:
+                            # The session is gone or refused the chunk, retrying won't help
+                            failure = RuntimeError(f"Receiver answered {response.status_code}: {response.text}")
+                            fatal = True
+                        else:
+                            response.raise_for_status()
+                            complete = response.json().get('complete', False)
+                    except (requests.RequestException, ValueError) as e:
+                        failure = e
+                    with condition:
+                        state['active'] -= 1
+                        if complete:
+                            # The receiver has every range, including any still queued for a retry
+                            state['complete'] = True
+                            ranges.clear()
+                            state['outstanding'] = 0
+                        if failure is None:
+                            state['sent'] = min(state['sent'] + length, file_size)
+                            state['done'] += 1
+                            state['outstanding'] = max(state['outstanding'] - 1, 0)
+                            state['failures'] = 0
+                        elif state['error'] is None:
+                            ranges.append((offset, length))
+                            state['failures'] += 1
+                            if fatal or state['failures'] > RESUMABLE_MAX_RETRIES:
+                                state['error'] = failure
+                            else:
+                                logger.warning(f"Chunk at {offset} to {device_ip} failed ({str(failure)}), retrying...")
+                        condition.notify_all()
+                    if failure is not None and state['error'] is None:
+                        time.sleep(min(2 ** state['failures'], 30))
+        
+        stripes = [threading.Thread(target=stripe, daemon=True) for _ in range(STRIPE_MAX)]
+        for thread in stripes:
+            thread.start()
+        
+        sample_time, sample_sent, sample_done, last_rate = time.time(), 0, 0, None
+        while any(thread.is_alive() for thread in stripes):
+            time.sleep(0.25)
+            if cancelled is not None and cancelled.is_set() and state['error'] is None:
+                with condition:
+                    if state['error'] is None:
+                        state['error'] = IOError("Upload was cancelled")
+                    condition.notify_all()
+            if progress:
+                progress(state['sent'])
+            
+            # Only judge a stripe count once every stripe has finished a chunk with it
+            now = time.time()
+            if now - sample_time < STRIPE_SAMPLE_INTERVAL or state['done'] - sample_done < state['target']:
+                continue
+            rate = (state['sent'] - sample_sent) / (now - sample_time)
+            with condition:
+                if last_rate is None or rate > last_rate * (1 + STRIPE_GAIN):
+                    state['target'] = min(state['target'] + 1, STRIPE_MAX)
+                elif rate < last_rate * (1 - STRIPE_GAIN):
+                    state['target'] = max(state['target'] - 1, STRIPE_MIN)
+                condition.notify_all()
+            sample_time, sample_sent, sample_done, last_rate = now, state['sent'], state['done'], rate
+        
+        if state['outstanding']:
+            raise state['error']
+        peer_stripe_counts[device_ip] = state['target']
+        logger.info(f"Sent {file_path} to {device_ip} over {state['target']} stripes")
+        return True
+    except Exception as e:
+        logger.error(f"Error sending file to {device_ip}: {str(e)}")
+        if session_url is not None:
+            # Drop the half-written session on the receiver
+            try:
+                peer_client.delete(session_url, timeout=PEER_CHECK_TIMEOUT)
+            except requests.RequestException:
+                pass
+        return False
+
+class QueueWriter:
+    """Write-only file object that hands its bytes to a queue for a streaming upload."""
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def write(self, data):
+        if data:
+            data = bytes(data)
+            # Block while the upload is behind, but give up once it's gone
+            while True:
+                if self.cancelled.is_set():
+                    raise IOError("Upload was cancelled")
+                try:
+                    self.chunks.put(data, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def pack_folder_tar(folder_path, writer, compression):
+    """Pack a folder or a FileBatch into a tar stream, compressing it with gzip or zstd if asked."""
+    zstd_writer = None
+    target = writer
+    mode = 'w|'
+    if compression == 'zstd':
+        zstd_writer = zstandard.ZstdCompressor().stream_writer(writer)
+        target = zstd_writer
+    elif compression == 'gzip':
+        mode = 'w|gz'
+    with tarfile.open(fileobj=target, mode=mode, bufsize=TAR_STREAM_BUFFER_SIZE) as tar:
+        if isinstance(folder_path, FileBatch):
+            for name, file_path in folder_path.files:
+                if isinstance(file_path, UploadBuffer):
+                    member = tarfile.TarInfo(name)
+                    member.size = file_path.size
+                    member.mtime = int(time.time())
+                    with file_path.open() as f:
+                        tar.addfile(member, f)
+                else:
+                    tar.add(file_path, arcname=name)
+        else:
+            tar.add(folder_path, arcname=os.path.basename(os.path.normpath(folder_path)))
+    if zstd_writer:
+        zstd_writer.close()  # Flush the end of the zstd frame
+
+def iter_folder_tar(folder_path, compression):
+    """Yield a folder's tar stream in chunks while a worker thread packs it."""
+    chunks = queue.Queue(maxsize=TAR_STREAM_QUEUE_SIZE)
+    # Only stops the packer; cancelling the transfer is up to whoever reads the chunks
+    packer_stopped = threading.Event()
+    
+    def producer():
+        try:
+            pack_folder_tar(folder_path, QueueWriter(chunks, packer_stopped), compression)
+            chunks.put(None)
+        except Exception as e:
+            if not packer_stopped.is_set():
+                chunks.put(e)
+    
+    create_thread(target=producer).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # Unblocks the packer if the upload stopped early
+        packer_stopped.set()
+
+def peer_accepts_zstd(device_ip):
+    """Whether a peer can unpack zstd tar streams, going by its beacon or its /health answer."""
+    peer = get_peer_registry().get(device_ip) or {}
+    if 'transfer_modes' in peer:
+        return 'zstd' in peer['transfer_modes']
+    try:
+        response = peer_client.get(f"http://{device_ip}:{FLASK_PORT}/health", timeout=RESUMABLE_REQUEST_TIMEOUT)
+        return response.status_code == 200 and 'zstd' in response.json().get('tar_compressions', [])
+    except Exception as e:
+        logger.warning(f"Could not ask {device_ip} about zstd support: {str(e)}")
+        return False
+
+def track_chunks(chunks, progress=None, cancelled=None):
+    """Pass an upload's chunks through, reporting progress and honouring cancellation."""
+    sent = 0
+    for chunk in chunks:
+        if cancelled is not None and cancelled.is_set():
+            raise IOError("Upload was cancelled")
+        yield chunk
+        sent += len(chunk)
+        if progress:
+            progress(sent)
+
+def send_folder_tar(folder_path, device_ip, compression=TAR_STREAM_COMPRESSION, progress=None, cancelled=None, chunks=None):
+    """Send a folder, or a FileBatch, as a tar stream that the receiver unpacks while it arrives."""
+    try:
+        if compression == 'zstd' and not peer_accepts_zstd(device_ip):
+            # Find out before streaming the whole folder, not from a 415 at the end
+            if chunks is not None:
+                chunks.close()
+                chunks = None
+            compression = 'none'
+        url = f"http://{device_ip}:{FLASK_PORT}/upload_tar"
+        params = {'compression': compression}
+        if isinstance(folder_path, FileBatch):
+            # Receiver reports the whole batch as one event
+            params['batch'] = 1
+        if chunks is None:
+            body = iter_folder_tar(folder_path, compression)
+        else:
+            # Broadcast branches carry the tar packed once with the default compression
+            body = (chunk for _, chunk in chunks)
+        response = peer_client.post(
+            url,
+            params=params,
+            data=track_chunks(body, progress, cancelled),
+            headers={'Content-Type': 'application/x-tar'},
+            timeout=PEER_REQUEST_TIMEOUT
+        )
+        if response.status_code == 415 and compression == 'zstd':
+            # Receiver said it takes zstd but can't decode it, send it uncompressed instead
+            if chunks is not None:
+                chunks.close()
+            return send_folder_tar(folder_path, device_ip, compression='none', progress=progress, cancelled=cancelled)
+        if response.status_code == 200:
+            return True
+        else:
+            logger.error(f"Failed to send folder to {device_ip}: {response.text}")
+            return False
+    except Exception as e:
+        logger.error(f"Error sending folder to {device_ip}: {str(e)}")
+        return False
+
+def send_file_multipart(file_path, device_ip, progress=None):
+    """Send a file to a device through the multipart /upload endpoint."""
     try:
         url = f"http://{device_ip}:{FLASK_PORT}/upload"
-        with open(file_path, 'rb') as f:
-            files = {'file': f}
-            response = requests.post(url, files=files)
+        with open_source(file_path) as f:
+            files = {'file': (source_name(file_path), f)}
+            response = peer_client.post(url, files=files, timeout=PEER_REQUEST_TIMEOUT)
             if response.status_code == 200:
+                # The multipart body is built in one go, so progress jumps to the end
+                if progress:
+                    progress(source_size(file_path))
                 return True
             else:
-                st.error(f"Failed to send file to {device_ip}: {response.text}")
+                logger.error(f"Failed to send file to {device_ip}: {response.text}")
                 return False
     except Exception as e:
-        st.error(f"Error sending file to {device_ip}: {str(e)}")
+        logger.error(f"Error sending file to {device_ip}: {str(e)}")
+        return False
+
+def download_range(url, temp_path, start, end, validator):
+    """Download bytes start..end of url into the same offsets of temp_path."""
+    position = start
+    failures = 0
+    with open(temp_path, 'r+b') as f:
+        while position <= end:
+            try:
+                with peer_client.get(
+                    url,
+                    headers={'Range': f"bytes={position}-{end}", 'If-Range': validator},
+                    stream=True,
+                    timeout=RESUMABLE_REQUEST_TIMEOUT
+                ) as response:
+                    if response.status_code != 206:
+                        # If-Range failed, so the file changed under us
+                        raise RuntimeError(f"Server answered {response.status_code} instead of 206 for range {position}-{end}")
+                    f.seek(position)
+                    requested = position
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        position += len(chunk)
+                    if position == requested:
+                        # An empty 206 would have us ask for the same range forever
+                        raise RuntimeError(f"Server sent no bytes for range {position}-{end}")
+            except requests.RequestException as e:
+                failures += 1
+                if failures > RESUMABLE_MAX_RETRIES:
+                    raise
+                delay = min(2 ** failures, 30)
+                logger.warning(f"Range {position}-{end} of {url} failed ({str(e)}), resuming in {delay}s...")
+                time.sleep(delay)
+
+def download_file_segmented(url, dest_path, segments=DOWNLOAD_SEGMENTS):
+    """Download a file over several parallel Range requests and stitch it together."""
+    temp_path = f"{dest_path}.part"
+    try:
+        head = peer_client.head(url, timeout=RESUMABLE_REQUEST_TIMEOUT)
+        head.raise_for_status()
+        total_size = int(head.headers.get('Content-Length', 0))
+        validator = head.headers.get('ETag') or head.headers.get('Last-Modified')
+        os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+        
+        if (head.headers.get('Accept-Ranges') != 'bytes' or not validator
+                or total_size < SEGMENTED_DOWNLOAD_MIN_SIZE or segments < 2):
+            # Not worth splitting, or the server can't do it
+            with peer_client.get(url, stream=True, timeout=RESUMABLE_REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(temp_path, 'wb') as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            os.replace(temp_path, dest_path)
+            return True
+        
+        # Preallocate so every segment can write at its own offset
+        with open(temp_path, 'wb') as f:
+            f.truncate(total_size)
+        
+        segment_size = -(-total_size // segments)
+        ranges = [
+            (start, min(start + segment_size, total_size) - 1)
+            for start in range(0, total_size, segment_size)
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(download_range, url, temp_path, start, end, validator)
+                for start, end in ranges
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        
+        os.replace(temp_path, dest_path)
+        return True
+    except Exception as e:
+        logger.error(f"Error downloading {url}: {str(e)}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
         return False
 
+def fetch_from_peer(ip, relative_path):
+    """Download a file from a peer's downloads folder into ours; returns the local path or None."""
+    relative_path = relative_path.strip().replace('\\', '/').strip('/')
+    if not relative_path:
+        return None
+    url = f"http://{ip}:{FLASK_PORT}/download/{quote(relative_path)}"
+    filename = os.path.basename(relative_path)
+    try:
+        # Folders come as a zip, named in the Content-Disposition header
+        head = peer_client.head(url, timeout=RESUMABLE_REQUEST_TIMEOUT)
+        disposition = Message()
+        disposition['Content-Disposition'] = head.headers.get('Content-Disposition', '')
+        filename = os.path.basename(disposition.get_filename() or '') or filename
+    except requests.RequestException as e:
+        logger.warning(f"Could not ask {ip} what {relative_path} is called: {str(e)}")
+    dest_path = os.path.join(UPLOAD_FOLDER, filename)
+    if download_file_segmented(url, dest_path):
+        return dest_path
+    return None
+
 # Configure Streamlit page
 st.set_page_config(
     page_title="SharedInit - LAN File Sharing App",
@@ -585,143 +1447,6 @@ def get_local_ip():
         st.warning(f"Could not determine local IP: {str(e)}")
         return "127.0.0.1"
 
-def get_network_range():
-    """Get the network range based on local IP."""
-    local_ip = get_local_ip()
-    ip_parts = local_ip.split('.')
-    return f"{ip_parts[0]}.{ip_parts[1]}.{ip_parts[2]}.0/24"
-
-def check_app_instance(ip):
-    """Check if a host is running our Streamlit app."""
-    try:
-        # Try to connect to the Streamlit port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(0.5)  # 500ms timeout for each connection attempt
-        result = sock.connect_ex((ip, STREAMLIT_PORT))
-        sock.close()
-        
-        if result == 0:
-            # Try multiple methods to get hostname
-            hostname = None
-            try:
-                # Method 1: Try reverse DNS lookup
-                hostname = socket.gethostbyaddr(ip)[0]
-            except:
-                try:
-                    # Method 2: Try to get hostname from the device
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(0.5)
-                    sock.connect((ip, STREAMLIT_PORT))
-                    sock.send(b"GET /_stcore/stream HTTP/1.1\r\nHost: " + ip.encode() + b"\r\n\r\n")
-                    response = sock.recv(1024).decode()
-                    sock.close()
-                    
-                    # Look for hostname in response headers
-                    for line in response.split('\n'):
-                        if 'X-Hostname:' in line:
-                            hostname = line.split('X-Hostname:')[1].strip()
-                            break
-                except:
-                    pass
-            
-            # If hostname is still None, use IP as hostname
-            if not hostname:
-                hostname = ip
-            
-            # Try to detect platform
-            platform_type = "Unknown"
-            try:
-                # Try multiple endpoints to get platform info
-                endpoints = [
-                    f"http://{ip}:{STREAMLIT_PORT}/_stcore/health",
-                    f"http://{ip}:{STREAMLIT_PORT}/_stcore/stream",
-                    f"http://{ip}:{STREAMLIT_PORT}"
-                ]
-                
-                for endpoint in endpoints:
-                    try:
-                        response = requests.get(endpoint, timeout=0.5)
-                        if response.status_code == 200:
-                            # Check all possible platform headers
-                            platform_type = (
-                                response.headers.get('X-Platform') or
-                                response.headers.get('X-Platform-Version') or
-                                response.headers.get('X-Platform-Machine') or
-                                'Unknown'
-                            )
-                            if platform_type != 'Unknown':
-                                break
-                    except:
-                        continue
-                
-                # If still unknown, try to detect from hostname and other methods
-                if platform_type == "Unknown":
-                    try:
-                        # Try to detect platform from hostname patterns
-                        hostname_lower = hostname.lower()
-                        if 'mac' in hostname_lower or 'darwin' in hostname_lower:
-                            platform_type = "Darwin"
-                        elif 'win' in hostname_lower or 'windows' in hostname_lower or 'pc' in hostname_lower:
-                            platform_type = "Windows"
-                        elif 'linux' in hostname_lower:
-                            platform_type = "Linux"
-                        
-                        # Additional Windows detection
-                        if platform_type == "Unknown":
-                            try:
-                                # Try to get Windows-specific information
-                                response = requests.get(f"http://{ip}:{STREAMLIT_PORT}/_stcore/stream", timeout=0.5)
-                                if response.status_code == 200:
-                                    # Check for Windows-specific headers or patterns
-                                    if any(win_header in response.headers for win_header in ['X-Windows', 'X-Win32', 'X-Windows-NT']):
-                                        platform_type = "Windows"
-                                    # Check user agent for Windows
-                                    user_agent = response.headers.get('User-Agent', '').lower()
-                                    if 'windows' in user_agent or 'win32' in user_agent or 'win64' in user_agent:
-                                        platform_type = "Windows"
-                            except:
-                                pass
-                    except:
-                        pass
-            except:
-                pass
-            
-            return {
-                "ip": ip,
-                "hostname": hostname,
-                "status": "Online",
-                "last_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "platform": platform_type
-            }
-    except:
-        pass
-    return None
-
-def scan_network():
-    """Scan the network for other instances of our app."""
-    network = ipaddress.ip_network(get_network_range())
-    active_hosts = []
-    
-    # Get local IP to exclude it from scanning
-    local_ip = get_local_ip()
-    
-    # Get list of IPs to scan (excluding local IP)
-    ips_to_scan = [str(ip) for ip in network.hosts() if str(ip) != local_ip]
-    total_ips = len(ips_to_scan)
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-        future_to_ip = {
-            executor.submit(check_app_instance, ip): ip 
-            for ip in ips_to_scan
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_ip):
-            result = future.result()
-            if result:
-                active_hosts.append(result)
-    
-    return active_hosts
-
 def open_file_with_default_app(file_path):
     """Open a file with the default application based on its extension."""
     try:
@@ -952,103 +1677,57 @@ def get_file_mime_type(file_path):
                 pass
     return mime_type or 'application/octet-stream'
 
-def broadcast_presence():
-    """Broadcast this app's presence to the network."""
-    while True:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            
-            message = {
-                'type': 'presence',
-                'ip': get_local_ip(),
-                'hostname': socket.gethostname(),
-                'platform': platform.system(),
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            sock.sendto(json.dumps(message).encode(), ('<broadcast>', STREAMLIT_PORT))
-            sock.close()
-            
-            time.sleep(BROADCAST_INTERVAL)
-        except Exception as e:
-            print(f"Broadcast error: {e}")
-            time.sleep(BROADCAST_INTERVAL)
+def presence_message():
+    """This app's presence beacon: who we are and whether and how we can take files right now."""
+    try:
+        response = peer_client.get(f"http://localhost:{FLASK_PORT}/downloads_state", timeout=2)
+        downloads_enabled = response.json().get('downloads_enabled') if response.status_code == 200 else None
+    except Exception:
+        # File server is down, so nobody should count on it
+        downloads_enabled = None
+    try:
+        free_disk = shutil.disk_usage(UPLOAD_FOLDER).free
+    except OSError:
+        free_disk = None
+    try:
+        load = round(os.getloadavg()[0] / (os.cpu_count() or 1), 2)
+    except (AttributeError, OSError):
+        load = None  # No load average on Windows
+    return {
+        'type': 'presence',
+        'version': PRESENCE_VERSION,
+        'ip': get_local_ip(),
+        'hostname': socket.gethostname(),
+        'platform': platform.system(),
+        'timestamp': datetime.now().isoformat(),
+        'flask_port': FLASK_PORT,
+        'downloads_enabled': downloads_enabled,
+        'free_disk': free_disk,
+        'load': load,
+        'transfer_modes': TRANSFER_MODES
+    }
 
 def start_background_tasks():
-    """Start background tasks for broadcasting and listening."""
-    if not st.session_state.background_threads_started:
-        # Initialize active_connections if it doesn't exist
-        if 'active_connections' not in st.session_state:
-            st.session_state.active_connections = {}
-            
-        # Start broadcast thread
-        broadcast_thread = create_thread(target=broadcast_presence)
-        broadcast_thread.start()
-        
-        # Start listen thread
-        listen_thread = create_thread(target=listen_for_broadcasts)
-        listen_thread.start()
-        
-        st.session_state.background_threads_started = True
-
-def process_connection_queue():
-    """Process any new connections from the queue."""
-    try:
-        while not connection_queue.empty():
-            connection_info = connection_queue.get_nowait()
-            st.session_state.active_connections[connection_info['ip']] = connection_info
-    except queue.Empty:
-        pass
+    """Have the process-wide discovery service broadcast this app's presence."""
+    # One broadcaster and listener per process, however many sessions are open
+    get_discovery_service().set_presence(presence_message)
 
-def listen_for_broadcasts():
-    """Listen for presence broadcasts from other instances."""
-    sock = None
-    while True:
-        try:
-            if sock is None:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                try:
-                    sock.bind(('', STREAMLIT_PORT))
-                except OSError as e:
-                    if e.errno == 48:  # Address already in use
-                        print("Port is already in use, waiting for it to be released...")
-                        time.sleep(5)  # Wait before retrying
-                        continue
-                    else:
-                        raise
-            
-            data, addr = sock.recvfrom(1024)
-            message = json.loads(data.decode())
-            
-            if message['type'] == 'presence' and message['ip'] != get_local_ip():
-                # Create a new connection info dictionary
-                connection_info = {
-                    'ip': message['ip'],
-                    'hostname': message['hostname'],
-                    'platform': message['platform'],
-                    'last_seen': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    'status': 'Online'
-                }
-                
-                # Put the connection info in the queue instead of directly accessing session state
-                connection_queue.put(connection_info)
-                
-        except Exception as e:
-            print(f"Listen error: {e}")
-            if sock is not None:
-                try:
-                    sock.close()
-                except:
-                    pass
-                sock = None
-            time.sleep(1)  # Add a small delay to prevent tight error loops
+def start_peer_revalidation():
+    """Check the peers again in the background, unless that is running or happened just now."""
+    get_discovery_service().request_scan(PEER_REVALIDATE_INTERVAL)
 
 class FileHandler(FileSystemEventHandler):
+    def on_moved(self, event):
+        # The file server writes to a hidden temp name and renames it into place
+        if not event.is_directory:
+            self.on_created(FileCreatedEvent(event.dest_path))
+
     def on_created(self, event):
         if not event.is_directory:
             file_path = event.src_path
+            # Skip in-progress temp files like .name.<id>.part
+            if os.path.basename(file_path).startswith('.'):
+                return
             if file_path.startswith(os.path.abspath(UPLOAD_FOLDER)):
                 try:
                     # Get file extension
@@ -1300,100 +1979,381 @@ def is_matlab_file(filename):
     """Check if the file is a MATLAB file."""
     return get_file_extension(filename) == '.m'
 
-def broadcast_file(file_path):
-    """Send a file to all connected devices."""
-    success_count = 0
-    total_devices = len(st.session_state.active_connections)
-    
-    if total_devices == 0:
-        st.warning("No devices connected to broadcast to.")
-        return
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i, (ip, device) in enumerate(st.session_state.active_connections.items()):
-        status_text.text(f"Checking {device['hostname']} ({ip})...")
-        
-        # First check if downloads are enabled on the receiver
-        try:
-            check_response = requests.post(
-                f"http://{ip}:{FLASK_PORT}/downloads_enabled",
-                json={'downloads_enabled': True},
-                headers={'Content-Type': 'application/json'}
+def get_transfer_size(file_path):
+    """Total bytes a transfer of file_path will carry, for progress reporting."""
+    if is_folder(file_path):
+        total = 0
+        for root, _, files in os.walk(file_path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+    return source_size(file_path)
+
+def reported_downloads_enabled(ip):
+    """Whether a peer takes files according to its last report, or None if that is too old to trust."""
+    peer = get_peer_registry().fresh(ip, PRESENCE_MAX_AGE)
+    if peer is None or peer.get('downloads_enabled') not in ("Enabled", "Disabled"):
+        return None
+    return peer['downloads_enabled'] == "Enabled"
+
+def check_downloads_enabled(ip):
+    """Ask a peer whether it currently accepts files."""
+    reported = reported_downloads_enabled(ip)
+    if reported is not None:
+        return reported
+    response = peer_client.post(
+        f"http://{ip}:{FLASK_PORT}/downloads_enabled",
+        json={'downloads_enabled': True},
+        headers={'Content-Type': 'application/json'},
+        timeout=PEER_CHECK_TIMEOUT
+    )
+    if response.status_code != 200:
+        return None
+    return response.json().get('downloads_enabled', False)
+
+def check_peer(ip, transfer):
+    """Ask a peer whether it takes files, marking the transfer skipped or unreachable if not."""
+    transfer['status'] = 'checking'
+    try:
+        enabled = check_downloads_enabled(ip)
+    except Exception as e:
+        logger.warning(f"Could not reach {transfer['hostname']}: {str(e)}")
+        enabled = None
+    if enabled is None:
+        logger.warning(f"Could not check downloads state on {transfer['hostname']}, skipping...")
+        transfer['status'] = 'unreachable'
+        return False
+    if not enabled:
+        logger.info(f"Downloads disabled on {transfer['hostname']}, skipping...")
+        transfer['status'] = 'skipped'
+        return False
+    transfer['status'] = 'ready'
+    return True
+
+def finish_transfer(transfer, sent):
+    """Record how a peer transfer ended."""
+    if sent:
+        transfer['sent'] = max(transfer['sent'], transfer['total'])
+        transfer['status'] = 'sent'
+    elif transfer['cancelled'].is_set():
+        transfer['status'] = 'timed out' if transfer.get('timed_out') else 'cancelled'
+    else:
+        transfer['status'] = 'failed'
+    return sent
+
+def send_to_peer(file_path, ip, transfer, tee=None):
+    """Fan-out worker: check one peer and send it the file, recording the outcome in transfer."""
+    sent = False
+    try:
+        transfer['started'] = time.time()
+        if not check_peer(ip, transfer):
+            return False
+        transfer['status'] = 'sending'
+        def progress(sent):
+            transfer['sent'] = sent
+        chunks = tee.branch(ip, transfer['cancelled']) if tee is not None else None
+        sent = send_file_to_device(file_path, ip, progress=progress, cancelled=transfer['cancelled'], chunks=chunks)
+    except Exception as e:
+        logger.error(f"Error checking/sending to {transfer['hostname']}: {str(e)}")
+    finally:
+        # Don't let the shared read wait on a peer that is done
+        if tee is not None:
+            tee.detach(ip)
+    return finish_transfer(transfer, sent)
+
+def send_file_relay(file_path, device_ip, relay_peers, progress=None, cancelled=None, chunks=None):
+    """Stream a file to a peer that passes it on to relay_peers; returns {ip: status} for those it reached."""
+    try:
+        url = f"http://{device_ip}:{FLASK_PORT}/upload_stream/{quote(source_name(file_path))}"
+        file_size = source_size(file_path)
+        with open_source(file_path) as f:
+            source = f if chunks is None else ChunkReader(chunks)
+            response = peer_client.put(
+                url,
+                data=ProgressReader(source, file_size, progress, cancelled),
+                headers={
+                    'Content-Type': 'application/octet-stream',
+                    'Content-Length': str(file_size),
+                    'X-Relay-Peers': ','.join(relay_peers)
+                },
+                timeout=RELAY_REQUEST_TIMEOUT
             )
-            
-            if check_response.status_code == 200:
-                data = check_response.json()
-                if not data.get('downloads_enabled', False):
-                    logger.info(f"Downloads disabled on {device['hostname']}, skipping...")
+        if response.status_code == 403:
+            return {device_ip: 'skipped'}
+        if response.status_code == 404:
+            # Older peers only know the multipart /upload endpoint, and can't relay
+            legacy_upload_peers.add(device_ip)
+            return {device_ip: 'legacy'}
+        if response.status_code != 200:
+            logger.error(f"Failed to relay file through {device_ip}: {response.text}")
+            return {device_ip: 'failed'}
+        results = {device_ip: 'sent'}
+        results.update(response.json().get('relay_results', {}))
+        return results
+    except Exception as e:
+        logger.error(f"Error relaying file through {device_ip}: {str(e)}")
+        return {device_ip: 'failed'}
+
+def relay_to_subtree(file_path, seed, subtree, transfers, tee=None):
+    """Relay-mode worker: upload to a seed peer that passes the file on down its subtree."""
+    chunks = tee.branch(seed, transfers[seed]['cancelled']) if tee is not None else None
+    try:
+        while True:
+            transfer = transfers[seed]
+            transfer['started'] = time.time()
+            transfer['status'] = 'sending'
+            for ip in subtree:
+                transfers[ip]['status'] = 'relaying'
+            def progress(sent, transfer=transfer):
+                transfer['sent'] = sent
+            results = send_file_relay(file_path, seed, subtree, progress=progress, cancelled=transfer['cancelled'], chunks=chunks)
+            if tee is not None:
+                # Any retry reads from disk, the shared read has moved on
+                tee.detach(seed)
+                chunks = tee = None
+            for ip, status in results.items():
+                if ip not in transfers:
                     continue
-            else:
-                logger.warning(f"Could not check downloads state on {device['hostname']}, skipping...")
-                continue
-                
-            # If downloads are enabled, send the file
-            status_text.text(f"Sending to {device['hostname']} ({ip})...")
-            if send_file_to_device(file_path, ip):
-                success_count += 1
-                
-        except Exception as e:
-            logger.error(f"Error checking/sending to {device['hostname']}: {str(e)}")
-            continue
+                if status == 'legacy':
+                    # Too old for streamed uploads, give it the file the old way
+                    transfers[ip].update(status='queued', sent=0, started=None)
+                    send_to_peer(file_path, ip, transfers[ip])
+                elif status in ('sent', 'failed'):
+                    finish_transfer(transfers[ip], status == 'sent')
+                else:
+                    transfers[ip]['status'] = status
             
-        progress_bar.progress((i + 1) / total_devices)
+            # Peers nobody reported on (the seed failed, or is too old to relay) get a new seed
+            remaining = [ip for ip in subtree if ip not in results]
+            if not remaining or (transfer['cancelled'].is_set() and not transfer.get('timed_out')):
+                break
+            seed, subtree = remaining[0], remaining[1:]
+    finally:
+        if tee is not None:
+            tee.detach(seed)
+    for ip in subtree:
+        if transfers[ip]['status'] == 'relaying':
+            finish_transfer(transfers[ip], False)
+
+class GroupCancelled:
+    """Cancellation flag for a transfer shared by several peers, set once all of them are cancelled."""
+    def __init__(self, transfers):
+        self.transfers = transfers
+
+    def is_set(self):
+        return all(transfer['cancelled'].is_set() for transfer in self.transfers)
+
+def multicast_to_peers(file_path, ips, transfers):
+    """Multicast-mode worker: send a file to every ready peer in one multicast transfer."""
+    group = [transfers[ip] for ip in ips]
+    started = time.time()
+    for transfer in group:
+        transfer['status'] = 'sending'
+        transfer['started'] = started
+    def progress(sent):
+        for transfer in group:
+            transfer['sent'] = sent
+    
+    config = load_config()
+    try:
+        results = multicast.send_file_multicast(
+            file_path,
+            ips,
+            filename=source_name(file_path),
+            interface=config.get('multicast_interface') or get_local_ip(),
+            rate=config.get('multicast_rate', multicast.MULTICAST_RATE),
+            progress=progress,
+            cancelled=GroupCancelled(group)
+        )
+    except Exception as e:
+        logger.error(f"Multicast send of {file_path} failed: {str(e)}")
+        results = {}
+    for ip in ips:
+        status = results.get(ip, 'failed')
+        if status == 'skipped':
+            transfers[ip]['status'] = 'skipped'
+        else:
+            finish_transfer(transfers[ip], status == 'sent')
+
+def watch_transfers(futures, transfers, on_update, timeout):
+    """Wait for fan-out workers, cancelling peers that run over timeout and reporting progress."""
+    pending = set(futures)
+    while pending:
+        _, pending = concurrent.futures.wait(pending, timeout=0.25)
+        now = time.time()
+        for transfer in transfers.values():
+            if (transfer['status'] == 'sending' and transfer['started'] and now - transfer['started'] > timeout
+                    and not transfer['cancelled'].is_set()):
+                logger.warning(f"Sending to {transfer['hostname']} took longer than {timeout}s, cancelling...")
+                transfer['timed_out'] = True
+                transfer['cancelled'].set()
+        if on_update:
+            on_update(transfers)
+
+def fan_out_file(file_path, peers, on_update=None, workers=None, timeout=PEER_SEND_TIMEOUT):
+    """Send a file to several peers at once.
     
-    progress_bar.empty()
-    status_text.empty()
+    peers maps ip to hostname. on_update is called from the calling thread
+    every so often with the per-peer transfer dicts, so it may touch the UI.
+    A peer that takes longer than timeout seconds is cancelled, and if the
+    caller is interrupted every outstanding transfer is cancelled.
+    With multicast_enabled set in the config a file goes to all peers in one
+    multicast transfer, and peers it doesn't reach get a normal upload.
+    Otherwise, with relay_enabled set, broadcasts of a file to relay_min_peers
+    or more peers only upload to a few seed peers, which pass it on down a
+    relay tree.
+    Returns the transfer dicts keyed by ip.
+    """
+    config = load_config()
+    if workers is None:
+        workers = config.get('fanout_workers', FANOUT_WORKERS)
+    total = get_transfer_size(file_path)
+    transfers = {
+        ip: {
+            'hostname': hostname,
+            'status': 'queued',
+            'sent': 0,
+            'total': total,
+            'started': None,
+            'cancelled': threading.Event()
+        }
+        for ip, hostname in peers.items()
+    }
+    workers = max(1, min(workers, len(peers)))
+    ips = list(peers)
     
-    if success_count == total_devices:
-        st.success(f"Successfully sent file to all {total_devices} devices!")
-    elif success_count > 0:
-        st.warning(f"Sent file to {success_count} out of {total_devices} devices.")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        is_file = not is_packed(file_path)
+        multicast_mode = is_file and len(peers) > 1 and config.get('multicast_enabled', False)
+        relay_mode = is_file and config.get('relay_enabled', False) and len(peers) >= config.get('relay_min_peers', RELAY_MIN_PEERS)
+        if multicast_mode or relay_mode:
+            checks = {executor.submit(check_peer, ip, transfers[ip]): ip for ip in ips}
+            watch_transfers(checks, transfers, on_update, timeout)
+            ready = [ip for ip in ips if transfers[ip]['status'] == 'ready']
+        
+        if multicast_mode:
+            if ready:
+                watch_transfers([executor.submit(multicast_to_peers, file_path, ready, transfers)], transfers, on_update, timeout)
+            # Whoever the multicast didn't reach gets a normal upload
+            retry = [ip for ip in ready if transfers[ip]['status'] == 'failed']
+            for ip in retry:
+                transfers[ip].update(status='queued', sent=0, started=None)
+            futures = {executor.submit(send_to_peer, file_path, ip, transfers[ip]): ip for ip in retry}
+        elif relay_mode:
+            seeds = split_relay_peers(ready, min(config.get('relay_seeds', RELAY_SEEDS), workers))
+            tee = BroadcastTee(open_broadcast_source(file_path), [seed for seed, _ in seeds]) if len(seeds) > 1 else None
+            futures = {
+                executor.submit(relay_to_subtree, file_path, seed, subtree, transfers, tee): seed
+                for seed, subtree in seeds
+            }
+        else:
+            # Peers that run side by side share one read of the file. A tee group
+            # never outgrows the pool, so all of its receivers can be running at once.
+            tees = {}
+            for i in range(0, len(ips), workers):
+                group = ips[i:i + workers]
+                if len(group) > 1:
+                    tee = BroadcastTee(open_broadcast_source(file_path), group)
+                    for ip in group:
+                        tees[ip] = tee
+            futures = {
+                executor.submit(send_to_peer, file_path, ip, transfer, tees.get(ip)): ip
+                for ip, transfer in transfers.items()
+            }
+        watch_transfers(futures, transfers, on_update, timeout)
+    finally:
+        # Reached early only if the script was stopped, so stop every peer too
+        for transfer in transfers.values():
+            if transfer['status'] not in ('sent', 'skipped', 'unreachable', 'failed'):
+                transfer['cancelled'].set()
+        executor.shutdown(wait=False)
+    return transfers
+
+def run_queued_batch(file_path, peers, on_update):
+    """Send a queued file to its peers; used by the transfer queue workers."""
+    transfers = fan_out_file(file_path, peers, on_update=on_update)
+    return {ip: transfer['status'] for ip, transfer in transfers.items()}
+
+@st.cache_resource
+def get_transfer_queue():
+    """The process-wide outbound transfer queue, picking up where the last run left off."""
+    config = load_config()
+    transfer_queue = TransferQueue(
+        TRANSFER_QUEUE_DB,
+        send_batch=run_queued_batch,
+        workers=config.get('transfer_queue_workers', TRANSFER_QUEUE_WORKERS),
+        shortest_first=config.get('shortest_job_first', True)
+    )
+    transfer_queue.start()
+    return transfer_queue
+
+def queue_file_for_peers(file_path, peers):
+    """Put a file on the transfer queue for peers and say so in the UI."""
+    added = get_transfer_queue().enqueue(file_path, peers)
+    filename = source_name(file_path)
+    if added:
+        st.info(f"Queued {filename} for {added} device(s).")
     else:
-        st.error("Could not send file to any devices.")
+        st.info(f"{filename} is already queued for these devices.")
+
+def broadcast_file(file_path):
+    """Send a file to all connected devices."""
+    if not st.session_state.active_connections:
+        st.warning("No devices connected to broadcast to.")
+        return
+    
+    peers = {ip: device['hostname'] for ip, device in st.session_state.active_connections.items()}
+    queue_file_for_peers(file_path, peers)
 
 def send_file_to_selected_devices(file_path, selected_ips):
     """Send a file to only the selected devices."""
     if not selected_ips:
         st.warning("No devices selected to send the file to.")
         return
-    success_count = 0
-    total_devices = len(selected_ips)
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    for i, ip in enumerate(selected_ips):
-        device = st.session_state.active_connections.get(ip, {"hostname": ip})
-        status_text.text(f"Checking {device.get('hostname', ip)} ({ip})...")
-        try:
-            check_response = requests.post(
-                f"http://{ip}:{FLASK_PORT}/downloads_enabled",
-                json={'downloads_enabled': True},
-                headers={'Content-Type': 'application/json'}
-            )
-            if check_response.status_code == 200:
-                data = check_response.json()
-                if not data.get('downloads_enabled', False):
-                    logger.info(f"Downloads disabled on {device.get('hostname', ip)}, skipping...")
-                    continue
+    peers = {
+        ip: st.session_state.active_connections.get(ip, {"hostname": ip}).get('hostname', ip)
+        for ip in selected_ips
+    }
+    queue_file_for_peers(file_path, peers)
+
+@st.fragment(run_every=1)
+def show_transfer_queue():
+    """Live view of queued, running and recently finished sends."""
+    transfer_queue = get_transfer_queue()
+    jobs = transfer_queue.list_jobs()
+    if not jobs:
+        return
+    
+    st.header("Outgoing Transfers")
+    now = time.time()
+    for job in jobs:
+        label = f"{os.path.basename(job['file_path'])} → {job['hostname']} ({job['peer_ip']})"
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            if job['status'] == 'running':
+                st.progress(job.get('progress', 0.0), text=f"{label}: {job.get('transfer_status', 'starting')}")
+            elif job['status'] == 'pending':
+                if job['attempts']:
+                    wait = max(0, int(job['next_attempt'] - now))
+                    st.caption(f"🔁 {label}: {job['last_error']}, attempt {job['attempts'] + 1} in {wait}s")
+                else:
+                    st.caption(f"⏳ {label}: queued")
+            elif job['status'] == 'sent':
+                st.caption(f"✅ {label}: sent")
+            elif job['status'] == 'skipped':
+                st.caption(f"⏭️ {label}: downloads disabled on the device")
+            elif job['status'] == 'removed':
+                st.caption(f"🗑️ {label}: {job['last_error'] or 'cancelled'}")
             else:
-                logger.warning(f"Could not check downloads state on {device.get('hostname', ip)}, skipping...")
-                continue
-            status_text.text(f"Sending to {device.get('hostname', ip)} ({ip})...")
-            if send_file_to_device(file_path, ip):
-                success_count += 1
-        except Exception as e:
-            logger.error(f"Error checking/sending to {device.get('hostname', ip)}: {str(e)}")
-            continue
-        progress_bar.progress((i + 1) / total_devices)
-    progress_bar.empty()
-    status_text.empty()
-    if success_count == total_devices:
-        st.success(f"Successfully sent file to all {total_devices} selected devices!")
-    elif success_count > 0:
-        st.warning(f"Sent file to {success_count} out of {total_devices} selected devices.")
-    else:
-        st.error("Could not send file to any selected devices.")
+                st.caption(f"❌ {label}: failed after {job['attempts']} attempts ({job['last_error']})")
+        with col2:
+            if job['status'] in ('pending', 'running'):
+                if st.button("Cancel", key=f"cancel_transfer_{job['id']}"):
+                    transfer_queue.cancel(job['id'])
 
 def delete_file(file_path):
     """Delete a file and remove it from session state if it exists."""
@@ -1412,73 +2372,54 @@ def delete_file(file_path):
         st.error(f"Error deleting file: {str(e)}")
     return False
 
-@st.fragment(run_every=5)
-def auto_open_received_files(auto_open_enabled):
-    """Check file_events.json every 5 seconds and open new files."""
+@st.fragment(run_every=1)
+def watch_peer_registry():
+    """Rerun the app when a peer appears, drops off or changes."""
+    if get_peer_registry().version != st.session_state.get('peer_registry_version'):
+        st.rerun(scope="app")
+
+@st.fragment(run_every=1)
+def watch_file_events():
+    """Rerun the app as soon as the event subscriber has something new for this session."""
+    # Only looks at the in-memory buffer, so idle sessions cost no I/O
+    if get_file_event_subscriber().latest_seq > st.session_state.get('event_cursor', 0):
+        st.rerun(scope="app")
+
+def get_downloads_enabled():
+    """Ask the local file server whether downloads are currently enabled."""
     try:
-        if os.path.exists(EVENT_FILE):
-            events = []
-            # Read events
-            with open(EVENT_FILE, 'r') as f:
-                try:
-                    events = json.load(f)
-                except json.JSONDecodeError:
-                    logger.error("Error reading events file")
-            
-            # Process events if any exist
-            if events:
-                for event in events:
-                    if event['type'] == 'file_received':
-                        filename = event['filename']
-                        file_path = os.path.join(UPLOAD_FOLDER, filename)
-                        if os.path.exists(file_path) and auto_open_enabled:
-                            open_file_with_default_app(file_path)
-                            #logger.info(f"Auto-opened file: {filename}")
-                
-                # Clear the events file in a separate operation
-                with open(EVENT_FILE, 'w') as f:
-                    json.dump([], f)
-                    f.flush()
-                    st.rerun(scope="app")  # Ensure the write is completed
-                    
+        response = peer_client.get(f"http://localhost:{FLASK_PORT}/downloads_state", timeout=2)
+        if response.status_code == 200:
+            return response.json().get("downloads_enabled", True)
     except Exception as e:
-        logger.error(f"Error in auto_open_received_files: {str(e)}")
-        # Attempt to clear the file even if there was an error
-        try:
-            with open(EVENT_FILE, 'w') as f:
-                json.dump([], f)
-                f.flush()
-        except:
-            pass
+        logger.error(f"Error reading downloads state: {str(e)}")
+    return True
 
-@st.fragment(run_every=1)
-def is_state_enabled(downloads_enabled):
-    #logger.info(f"Current downloads_enabled state: {downloads_enabled}")
+def set_downloads_enabled(downloads_enabled):
+    """Push a new downloads enabled state to the local file server."""
+    try:
+        response = peer_client.put(
+            f"http://localhost:{FLASK_PORT}/downloads_state",
+            json={"downloads_enabled": downloads_enabled},
+            timeout=2
+        )
+        if response.status_code == 200:
+            return True
+        logger.error(f"File server rejected downloads state: {response.status_code}")
+    except Exception as e:
+        logger.error(f"Error pushing downloads state: {str(e)}")
     
-    # Save state to file for Flask server to read
+    # Server not reachable: persist it so the server picks it up when it starts
     try:
         with open("downloads_state.json", "w") as f:
             json.dump({"downloads_enabled": downloads_enabled}, f)
     except Exception as e:
         logger.error(f"Error saving downloads state: {str(e)}")
-    
-    st.markdown(
-        f"""
-        <script>
-            // Add downloads_enabled state to the page
-            const downloadsEnabled = {str(downloads_enabled).lower()};
-            document.body.setAttribute('data-downloads-enabled', downloadsEnabled);
-        </script>
-        """,
-        unsafe_allow_html=True
-    )
+    return False
 
 def main():
-    # Process any new connections from the queue
-    process_connection_queue()
-    
-    # Check for file events
-    check_file_events()
+    # Pick up peers found by scans and presence broadcasts
+    sync_active_connections()
     
     # Start file watcher if not already started
     if not hasattr(st.session_state, 'file_watcher'):
@@ -1499,12 +2440,20 @@ def main():
         auto_open_enabled = st.toggle("Auto-open Received Files", value=True, key="auto_open_toggle")
     with col3:
         if 'downloads_enabled' not in st.session_state:
-            st.session_state.downloads_enabled = True
+            st.session_state.downloads_enabled = get_downloads_enabled()
         downloads_enabled = st.toggle("Enable File Downloads", value=st.session_state.downloads_enabled, key="downloads_toggle")
+        if downloads_enabled != st.session_state.downloads_enabled:
+            # Only talk to the file server when the toggle actually flips
+            set_downloads_enabled(downloads_enabled)
+            # Let peers know now rather than at the next beacon
+            try:
+                get_discovery_service().announce()
+            except Exception as e:
+                logger.error(f"Error broadcasting presence: {str(e)}")
         st.session_state.downloads_enabled = downloads_enabled
     
-    # Update the downloads_enabled state
-    is_state_enabled(st.session_state.downloads_enabled)
+    # Check for file events, once the auto-open toggle has a value
+    check_file_events(auto_open_enabled)
     
     # Display local IP address and platform
     local_ip = get_local_ip()
@@ -1670,14 +2619,10 @@ def main():
         # Force a refresh to update the file list
         st.rerun()
     
-    # Perform initial scan if not done yet
+    # Known peers are listed straight away and checked again in the background
     if 'initial_scan_done' not in st.session_state:
-        with st.spinner("Performing initial network scan..."):
-            active_hosts = scan_network()
-            st.session_state.active_connections = {
-                host['ip']: host for host in active_hosts
-            }
-            st.session_state.initial_scan_done = True
+        start_peer_revalidation()
+        st.session_state.initial_scan_done = True
     
     # Start background tasks
     start_background_tasks()
@@ -1731,9 +2676,18 @@ def main():
                 key="file_uploader"
             )
             
+            # Off sends straight from memory and leaves the downloads folder alone
+            keep_sent_files = st.checkbox(
+                "Keep a copy of sent files in the downloads folder",
+                value=load_config().get('keep_sent_files', True),
+                key="keep_sent_files"
+            )
+            
             submit_button = st.form_submit_button("Send Files")
             
             if submit_button and uploaded_files:
+                sends = []
+                small_files = []
                 for uploaded_file in uploaded_files:
                     try:
                         # Check file size
@@ -1748,42 +2702,69 @@ def main():
                             st.error(f"File type {file_extension} for {uploaded_file.name} is not allowed")
                             continue
 
-                        # Create the full path including any subdirectories
-                        file_path = os.path.join(UPLOAD_FOLDER, uploaded_file.name)
-                        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                        if keep_sent_files:
+                            # Create the full path including any subdirectories
+                            file_path = os.path.join(UPLOAD_FOLDER, uploaded_file.name)
+                            os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-                        # Save the uploaded file
-                        with open(file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
+                            # Save the uploaded file
+                            with open(file_path, "wb") as f:
+                                f.write(uploaded_file.getbuffer())
+                        else:
+                            # Send straight from the upload, without a copy on disk
+                            file_path = UploadBuffer(uploaded_file.name, uploaded_file.getbuffer())
                         
-                        # Send the file to selected devices only
-                        send_file_to_selected_devices(file_path, st.session_state.selected_device_ips)
+                        # Scripts and zips still go on their own so the receiver runs or extracts them
+                        if (file_size <= SMALL_FILE_BATCH_MAX_SIZE
+                                and file_extension not in ['.sh', '.bash', '.zsh', '.ms', '.zip']):
+                            small_files.append((uploaded_file.name, file_path))
+                        else:
+                            sends.append(file_path)
                         
                     except Exception as e:
                         st.error(f"Error uploading file {uploaded_file.name}: {str(e)}")
                         st.error("Please try again with a different file or check file permissions.")
+                
+                # Lots of small files go out as one transfer per device instead of one each
+                if len(small_files) >= SMALL_FILE_BATCH_MIN_FILES:
+                    sends.append(FileBatch(small_files))
+                else:
+                    sends.extend(file_path for _, file_path in small_files)
+                for file_path in sends:
+                    try:
+                        # Send the file to selected devices only
+                        send_file_to_selected_devices(file_path, st.session_state.selected_device_ips)
+                    except Exception as e:
+                        st.error(f"Error sending {source_name(file_path)}: {str(e)}")
     else:
         st.info("File sending is currently disabled. Enable it using the toggle above to send files.")
+    
+    # Sends run from the persistent queue in the background
+    show_transfer_queue()
 
     # Display connected devices
     st.header("Connected Devices")
     
     if st.session_state.active_connections:
         for ip, device in st.session_state.active_connections.items():
-            # Get downloads state
+            # Get downloads state, from the peer's beacon when it is recent enough
             downloads_state = "Unknown"
-            try:
-                response = requests.post(
-                    f"http://{ip}:{FLASK_PORT}/downloads_enabled",
-                    json={'downloads_enabled': True},
-                    headers={'Content-Type': 'application/json'},
-                    timeout=0.5
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    downloads_state = "Enabled" if data.get('downloads_enabled', False) else "Disabled"
-            except:
-                pass
+            reported = reported_downloads_enabled(ip)
+            if reported is not None:
+                downloads_state = "Enabled" if reported else "Disabled"
+            else:
+                try:
+                    response = peer_client.post(
+                        f"http://{ip}:{FLASK_PORT}/downloads_enabled",
+                        json={'downloads_enabled': True},
+                        headers={'Content-Type': 'application/json'},
+                        timeout=0.5
+                    )
+                    if response.status_code == 200:
+                        data = response.json()
+                        downloads_state = "Enabled" if data.get('downloads_enabled', False) else "Disabled"
+                except:
+                    pass
 
             # Create colored orb based on state
             if downloads_state == "Enabled":
@@ -1794,6 +2775,22 @@ def main():
                 orb = "⚪"
 
             st.write(f"📱 {device['hostname']} ({ip}) - {device['status']}, Downloads: {orb} {downloads_state}")
+
+        # Pull a file from a device, over parallel ranges when it is large
+        with st.form("fetch_from_peer"):
+            fetch_ip = st.selectbox(
+                "Fetch a file from",
+                list(st.session_state.active_connections),
+                format_func=lambda ip: f"{st.session_state.active_connections[ip]['hostname']} ({ip})"
+            )
+            fetch_path = st.text_input("Path inside that device's downloads folder")
+            if st.form_submit_button("⬇️ Fetch"):
+                with st.spinner(f"Fetching {fetch_path}..."):
+                    fetched = fetch_from_peer(fetch_ip, fetch_path)
+                if fetched:
+                    st.success(f"✅ Saved {os.path.basename(fetched)} to the downloads folder")
+                else:
+                    st.error(f"❌ Could not fetch {fetch_path} from {fetch_ip}")
     else:
         st.info("No other devices connected. Start the app on other devices to enable file sharing.")
     
@@ -1812,7 +2809,7 @@ def main():
                 print(f"Last received file: {st.session_state.last_received_file}")
                 
                 # Open the file in default app
-                if st.session_state.last_received_file:
+                if auto_open_enabled and st.session_state.last_received_file:
                     file_path = os.path.join(UPLOAD_FOLDER, st.session_state.last_received_file)
                     logger.info(f"Attempting to open file: {file_path}")
                     print(f"Attempting to open file: {file_path}")
@@ -1850,8 +2847,9 @@ def main():
     > visit the [documentation](documentation) page.
     """)
 
-    # Only run auto_open_received_files if enabled
-    auto_open_received_files(auto_open_enabled)
+    # Pick up received files as soon as they arrive
+    watch_file_events()
+    watch_peer_registry()
 
 
 if __name__ == "__main__":
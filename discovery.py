@@ -0,0 +1,235 @@
+"""Process-wide peer discovery shared by every Streamlit session and page.
+
+One DiscoveryService per process owns the presence broadcast and the
+listener bound to the UDP presence port, the scan scheduler and the
+peer registry. Sessions and pages only read the registry and ask for a
+scan; a scan already running or done within the last interval is
+shared instead of started again. Known peers and hosts in the OS
+neighbour table are checked first, and the rest of the network is swept
+after them with a connect timeout fitted to the round trips seen.
+Thread and socket counts stay the same however many browser tabs are
+open. The main app supplies what the presence beacon says about this
+machine; until it has, the service only listens and scans.
+"""
+import errno
+import json
+import socket
+import threading
+import time
+import ipaddress
+import logging
+import streamlit as st
+import network_scan
+from peer_registry import get_peer_registry
+
+logger = logging.getLogger(__name__)
+
+# Constants
+PRESENCE_PORT = 8501  # UDP port presence beacons are broadcast to
+BROADCAST_INTERVAL = 10  # Seconds between presence beacons
+PRESENCE_VERSION = 2  # Presence beacon format; 2 adds downloads state, load, disk space and transfer modes
+PRESENCE_MAX_AGE = 3 * BROADCAST_INTERVAL  # Seconds a peer's beaconed state is trusted without asking it
+PRESENCE_MAX_BYTES = 4096  # Largest beacon read
+PEER_REVALIDATE_INTERVAL = 60  # Seconds before a scan asked for again really runs again
+
+def get_local_ip():
+    """Get the local IP address of the machine."""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        local_ip = s.getsockname()[0]
+        s.close()
+        return local_ip
+    except Exception as e:
+        logger.warning(f"Could not determine local IP: {str(e)}")
+        return "127.0.0.1"
+
+def get_network_range():
+    """Get the network range based on local IP and its interface netmask."""
+    return str(network_scan.local_network(get_local_ip()))
+
+def describe_presence(message):
+    """Turn a presence beacon into the connection dict the UI shows."""
+    connection_info = {
+        'ip': message['ip'],
+        'hostname': message['hostname'],
+        'platform': message['platform'],
+        'status': 'Online'
+    }
+    if message.get('version', 1) >= 2:
+        # Newer beacons carry the peer's state, so nobody has to ask it over HTTP
+        downloads_enabled = message.get('downloads_enabled')
+        connection_info.update({
+            'downloads_enabled': "Unknown" if downloads_enabled is None else ("Enabled" if downloads_enabled else "Disabled"),
+            'flask_port': message.get('flask_port', network_scan.SCAN_PORT),
+            'free_disk': message.get('free_disk'),
+            'load': message.get('load'),
+            'transfer_modes': message.get('transfer_modes', []),
+            'presence_version': message['version'],
+            'reported': time.time()
+        })
+    return connection_info
+
+class DiscoveryService:
+    """Presence broadcast, presence listener and peer scans for the whole process."""
+    def __init__(self, registry=None, port=PRESENCE_PORT, scan_port=network_scan.SCAN_PORT):
+        self.registry = registry if registry is not None else get_peer_registry()
+        self.port = port
+        self.scan_port = scan_port
+        self.presence = None  # Callable returning this machine's beacon, set by the main app
+        self.lock = threading.Lock()
+        self.started = False
+        self.scanning = False
+        self.scanned = 0
+        self.scan_total = 0
+        self.last_scan = 0
+        self.scan_done = threading.Event()
+        self.scan_done.set()
+
+    def start(self):
+        """Start the broadcast and listener threads, once per process."""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.broadcast, daemon=True).start()
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def set_presence(self, presence):
+        """Use presence() as this machine's beacon from now on."""
+        self.presence = presence
+
+    def announce(self):
+        """Broadcast one presence beacon now, if the app has said what to put in it."""
+        presence = self.presence
+        if presence is None:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(json.dumps(presence()).encode(), ('<broadcast>', self.port))
+        finally:
+            sock.close()
+
+    def broadcast(self):
+        """Broadcast this app's presence to the network."""
+        while True:
+            try:
+                self.announce()
+            except Exception as e:
+                logger.error(f"Broadcast error: {str(e)}")
+            time.sleep(BROADCAST_INTERVAL)
+
+    def listen(self):
+        """Listen for presence broadcasts from other instances."""
+        sock = None
+        while True:
+            try:
+                if sock is None:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    try:
+                        sock.bind(('', self.port))
+                    except OSError as e:
+                        if e.errno == errno.EADDRINUSE:
+                            logger.warning("Presence port is already in use, waiting for it to be released...")
+                            sock.close()
+                            sock = None
+                            time.sleep(5)
+                            continue
+                        raise
+
+                data, addr = sock.recvfrom(PRESENCE_MAX_BYTES)
+                message = json.loads(data.decode())
+
+                if message['type'] == 'presence' and message['ip'] != get_local_ip():
+                    self.registry.update(describe_presence(message))
+            except Exception as e:
+                logger.error(f"Listen error: {str(e)}")
+                if sock is not None:
+                    try:
+                        sock.close()
+                    except:
+                        pass
+                    sock = None
+                time.sleep(1)  # Add a small delay to prevent tight error loops
+
+    def request_scan(self, min_interval=PEER_REVALIDATE_INTERVAL):
+        """Scan in the background unless a scan is running or finished within min_interval.
+
+        Returns True if this call started a scan. Either way scan_done is set
+        once the likely hosts of the scan the caller can see are checked; the
+        sweep of the rest of the network may still be running then.
+        """
+        with self.lock:
+            if self.scanning or time.time() - self.last_scan < min_interval:
+                return False
+            self.scanning = True
+            self.scanned = self.scan_total = 0
+            self.scan_done.clear()
+        threading.Thread(target=self.scan, daemon=True).start()
+        return True
+
+    def scan(self):
+        """Check the likely hosts first, then sweep the rest of the network."""
+        rtts = []
+        cold = []
+        try:
+            cold = self.scan_likely_hosts(rtts)
+        except Exception as e:
+            logger.error(f"Error scanning for peers: {str(e)}")
+        # Whoever asked can go on, peers the sweep finds turn up in the registry
+        self.scan_done.set()
+        try:
+            connect_timeout = network_scan.adaptive_connect_timeout(rtts)
+            logger.info(f"Sweeping {len(cold)} more addresses with a {connect_timeout:.2f}s connect timeout")
+            for ip, host in network_scan.iter_scan(cold, port=self.scan_port, connect_timeout=connect_timeout):
+                if host:
+                    self.registry.update(host)
+        except Exception as e:
+            logger.error(f"Error sweeping for peers: {str(e)}")
+        finally:
+            with self.lock:
+                self.scanning = False
+                self.last_scan = time.time()
+
+    def scan_likely_hosts(self, rtts):
+        """Probe the known peers, then the OS neighbour table; returns the addresses left to sweep.
+
+        Known peers that don't answer are marked offline. The connect round
+        trips of every host that answered are added to rtts.
+        """
+        local_ip = get_local_ip()
+        network = ipaddress.ip_network(get_network_range())
+        known = [ip for ip in self.registry.known_ips() if ip != local_ip]
+        neighbors = [ip for ip in network_scan.neighbor_ips(network) if ip != local_ip and ip not in known]
+        self.scan_total = len(known) + len(neighbors)
+        on_connect = lambda ip, seconds: rtts.append(seconds)
+
+        missing = []
+        for ip, host in network_scan.iter_scan(known, port=self.scan_port, on_connect=on_connect):
+            self.scanned += 1
+            if host:
+                self.registry.update(host)
+            else:
+                missing.append(ip)
+        self.registry.mark_offline(missing)
+
+        for ip, host in network_scan.iter_scan(neighbors, port=self.scan_port, on_connect=on_connect):
+            self.scanned += 1
+            if host:
+                self.registry.update(host)
+
+        likely = set(known) | set(neighbors)
+        return [str(ip) for ip in network.hosts() if str(ip) != local_ip and str(ip) not in likely]
+
+    def progress(self):
+        """(addresses probed, addresses to probe) of the likely hosts of the running or last scan."""
+        return self.scanned, self.scan_total
+
+@st.cache_resource
+def get_discovery_service():
+    """The discovery service of this process, started on first use."""
+    service = DiscoveryService()
+    service.start()
+    return service
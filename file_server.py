@@ -1,10 +1,38 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import get_input_stream
 import os
+import socket
+import platform
 import logging
 from datetime import datetime
 import json
+import uuid
+from urllib.parse import quote
+import time
+import threading
+import queue
+import struct
+import zipfile
+import zlib
+import concurrent.futures
+import tarfile
+import sqlite3
+import hashlib
+import math
+from collections import Counter, deque
 import requests
+import peer_client
+from multicast import MulticastReceiver
+from relay import parse_relay_peers, split_relay_peers
+
+# zstd support for tar stream uploads is optional
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
 
 # Configure logging
 logging.basicConfig(
@@ -15,14 +43,54 @@ logger = logging.getLogger(__name__)
 
 # Constants
 CONFIG_FILE = "app_config.json"
+DOWNLOADS_STATE_FILE = "downloads_state.json"  # Persisted copy of the downloads toggle
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200MB max file size
 PORT = 8502  # Different port from Streamlit
-EVENT_FILE = "file_events.json"  # File to store events for Streamlit to read
+EVENT_DB = "file_events.db"  # Append-only journal of events for Streamlit to read
+EVENT_RETENTION_SECONDS = 60 * 60  # Journal entries older than this are compacted away
+EVENT_MAX_ROWS = 50000  # Hard cap on journal entries kept after compaction
+EVENT_COMPACT_INTERVAL = 5 * 60  # Seconds between journal compactions
+EVENT_READ_LIMIT = 1000  # Most events returned by one /check_events call
+EVENT_WAIT_TIMEOUT = 25  # Default seconds an /events/wait long-poll stays open
+EVENT_WAIT_MAX_TIMEOUT = 60  # Longest /events/wait a client may ask for
 STREAMLIT_PORT = 8501  # Port for Streamlit app
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB chunks when streaming request bodies to disk
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # Drop unfinished upload sessions after a day
+COMPLETED_SESSIONS_KEPT = 1000  # Committed striped sessions remembered for chunks retried after the commit
+ZIP_DEFLATE_LEVEL = 6  # zlib level for deflated folder archive members
+ZIP_EXTRACT_WORKERS = min(4, os.cpu_count() or 1)  # Threads inflating received zip members
+ZIP_EXTRACT_PARALLEL_MIN_MEMBERS = 8  # Smaller zips are extracted on the request thread
+COMPRESSION_SAMPLE_SIZE = 64 * 1024  # Bytes sampled to guess whether a member compresses
+ARCHIVE_STATS_HISTORY = 50  # Recent folder archives kept for /archive_stats
+RELAY_QUEUE_DEPTH = 8  # Chunks a relay child may fall behind the incoming upload
+RELAY_TIMEOUT = (5, 15 * 60)  # Connect timeout, and how long a child's whole subtree may take
+
+# Default store/deflate rules for folder archives, overridable through the
+# "compression_policy" key of app_config.json
+DEFAULT_COMPRESSION_POLICY = {
+    # Already compressed formats, deflating these burns CPU for nothing
+    'store_extensions': [
+        'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'cr2', 'nef', 'arw', 'dng',
+        'mp4', 'mov', 'avi', 'mkv', 'wmv', 'flv', 'm4v', 'webm',
+        'mp3', 'm4a', 'aac', 'ogg', 'flac', 'wma',
+        'zip', '7z', 'rar', 'gz', 'tgz', 'bz2', 'xz', 'zst',
+        'docx', 'xlsx', 'pptx', 'pdf', 'psd', 'ai', 'indd', 'f3d'
+    ],
+    # Text-like formats that always compress well
+    'deflate_extensions': [
+        'txt', 'csv', 'json', 'xml', 'html', 'htm', 'css', 'js', 'py', 'java',
+        'cpp', 'c', 'h', 'sql', 'm', 'ms', 'sh', 'bat', 'ps1', 'svg', 'dxf', 'obj', 'log'
+    ],
+    'entropy_threshold': 7.5,  # Bits per byte above which a sample is treated as incompressible
+    'min_deflate_size': 256  # Tiny members aren't worth a compressor
+}
 
 # Get the project root directory
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 DEFAULT_UPLOAD_FOLDER = os.path.join(PROJECT_ROOT, "downloads")
+UPLOAD_SESSION_DIR = os.path.join(PROJECT_ROOT, ".upload_sessions")  # Resumable upload state
+ARCHIVE_CACHE_DIR = os.path.join(PROJECT_ROOT, ".archive_cache")  # Generated folder archives
+DEFAULT_ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB, set archive_cache_max_bytes in the config to change
 
 def load_config():
     """Load configuration from file."""
@@ -42,6 +110,9 @@ def load_config():
 config = load_config()
 UPLOAD_FOLDER = config.get("download_folder", DEFAULT_UPLOAD_FOLDER)
 
+# Stats for the most recent folder archives
+archive_stats = deque(maxlen=ARCHIVE_STATS_HISTORY)
+
 # Create Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -54,37 +125,197 @@ def ensure_upload_folder():
         os.makedirs(UPLOAD_FOLDER)
         logger.info(f"Created directory: {os.path.abspath(UPLOAD_FOLDER)}")
 
-def write_event(event):
-    """Write an event to the event file."""
+def resolve_upload_path(filename):
+    """Resolve a client supplied filename to a path inside the upload folder."""
+    filename = filename.replace('\\', '/')
+    file_path = os.path.normpath(os.path.join(UPLOAD_FOLDER, filename))
+    
+    # Reject anything that would land outside the upload folder
+    if not os.path.abspath(file_path).startswith(os.path.join(os.path.abspath(UPLOAD_FOLDER), '')):
+        return None
+    return file_path
+
+def load_downloads_state():
+    """Load the persisted downloads enabled flag."""
     try:
-        events = []
-        if os.path.exists(EVENT_FILE):
-            with open(EVENT_FILE, 'r') as f:
-                try:
-                    events = json.load(f)
-                except json.JSONDecodeError:
-                    events = []
-        
-        events.append(event)
-        
-        with open(EVENT_FILE, 'w') as f:
-            json.dump(events, f)
-            f.flush()
+        if os.path.exists(DOWNLOADS_STATE_FILE):
+            with open(DOWNLOADS_STATE_FILE, "r") as f:
+                return json.load(f).get("downloads_enabled", True)
+    except Exception as e:
+        logger.error(f"Error loading downloads state: {str(e)}")
+    return True
+
+# The receiver state lives in memory; the file is only written when it changes
+downloads_state = {'enabled': load_downloads_state()}
+downloads_state_lock = threading.Lock()
+
+def downloads_are_enabled():
+    """Check whether this device currently accepts files."""
+    return downloads_state['enabled']
+
+def set_downloads_enabled(enabled):
+    """Update the downloads enabled flag, persisting it only if it changed."""
+    with downloads_state_lock:
+        if downloads_state['enabled'] == enabled:
+            return False
+        downloads_state['enabled'] = enabled
+        with open(DOWNLOADS_STATE_FILE + '.tmp', 'w') as f:
+            json.dump({"downloads_enabled": enabled}, f)
+        os.replace(DOWNLOADS_STATE_FILE + '.tmp', DOWNLOADS_STATE_FILE)
+    logger.info(f"Downloads {'enabled' if enabled else 'disabled'}")
+    return True
+
+def write_stream_to_file(stream, file_path):
+    """Copy a stream to file_path in chunks through a temp name and an atomic rename."""
+    temp_path = os.path.join(
+        os.path.dirname(file_path),
+        f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.part"
+    )
+    bytes_written = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                bytes_written += len(chunk)
+        os.replace(temp_path, file_path)
+    except Exception:
+        # Never leave a half written temp file behind
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return bytes_written
+
+# Event journal
+# Events live in an append-only SQLite table in WAL mode. AUTOINCREMENT gives
+# every event a sequence number that is never reused, even after compaction,
+# so readers can keep a cursor and ask for everything after it.
+event_db_local = threading.local()
+event_consume_lock = threading.Lock()
+
+# Long-polls wait on this; the generation moves on every write so a waiter
+# can tell whether it missed a notification between reading and waiting
+event_condition = threading.Condition()
+event_generation = 0
+
+def get_event_db():
+    """Get this thread's connection to the event journal."""
+    conn = getattr(event_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(EVENT_DB, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            'seq INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, event TEXT NOT NULL)'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS cursors (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)')
+        conn.commit()
+        event_db_local.conn = conn
+    return conn
+
+def write_events(events):
+    """Append events to the journal in one transaction and wake up long-polls."""
+    global event_generation
+    if not events:
+        return
+    try:
+        conn = get_event_db()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                'INSERT INTO events (created, event) VALUES (?, ?)',
+                [(now, json.dumps(event)) for event in events]
+            )
+        with event_condition:
+            event_generation += 1
+            event_condition.notify_all()
     except Exception as e:
-        logger.error(f"Error writing event: {str(e)}")
+        logger.error(f"Error writing events: {str(e)}")
+
+def write_event(event):
+    """Write an event to the event journal."""
+    write_events([event])
+
+def get_last_event_seq():
+    """Get the sequence number of the newest event ever written."""
+    row = get_event_db().execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+    return row[0] if row else 0
+
+def read_events(since, limit=EVENT_READ_LIMIT):
+    """Read events with a sequence number greater than since."""
+    rows = get_event_db().execute(
+        'SELECT seq, event FROM events WHERE seq > ? ORDER BY seq LIMIT ?',
+        (since, limit)
+    ).fetchall()
+    return [dict(json.loads(event), seq=seq) for seq, event in rows]
+
+def consume_events(cursor_name='default'):
+    """Read the events a named cursor hasn't seen yet and move the cursor past them."""
+    with event_consume_lock:
+        conn = get_event_db()
+        row = conn.execute('SELECT seq FROM cursors WHERE name = ?', (cursor_name,)).fetchone()
+        events = read_events(row[0] if row else 0)
+        if events:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cursors (name, seq) VALUES (?, ?)',
+                    (cursor_name, events[-1]['seq'])
+                )
+        return events
+
+def compact_events():
+    """Drop old journal entries and fold the WAL back into the database."""
+    conn = get_event_db()
+    with conn:
+        deleted = conn.execute(
+            'DELETE FROM events WHERE created < ?',
+            (time.time() - EVENT_RETENTION_SECONDS,)
+        ).rowcount
+        deleted += conn.execute(
+            'DELETE FROM events WHERE seq <= (SELECT MAX(seq) FROM events) - ?',
+            (EVENT_MAX_ROWS,)
+        ).rowcount
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    if deleted:
+        logger.info(f"Compacted {deleted} events from the journal")
+
+def run_event_compaction():
+    """Compact the event journal periodically."""
+    while True:
+        time.sleep(EVENT_COMPACT_INTERVAL)
+        try:
+            compact_events()
+        except Exception as e:
+            logger.error(f"Error compacting events: {str(e)}")
 
 @app.route('/downloads_enabled', methods=['POST'])
 def check_downloads_enabled():
     """Check if downloads are enabled."""
+    return jsonify({"downloads_enabled": downloads_are_enabled()})
+
+@app.route('/downloads_state', methods=['GET', 'PUT'])
+def downloads_state_endpoint():
+    """Read or, from this machine only, change the downloads enabled flag."""
+    if request.method == 'GET':
+        return jsonify({"downloads_enabled": downloads_are_enabled()}), 200
+    
+    # Peers may ask about the flag but only the local UI may flip it
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({'error': 'Access denied'}), 403
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('downloads_enabled'), bool):
+        return jsonify({'error': 'downloads_enabled must be true or false'}), 400
     try:
-        if os.path.exists("downloads_state.json"):
-            with open("downloads_state.json", "r") as f:
-                state = json.load(f)
-                return jsonify({"downloads_enabled": state.get("downloads_enabled", True)})
-        return jsonify({"downloads_enabled": True})
+        changed = set_downloads_enabled(data['downloads_enabled'])
+        return jsonify({"downloads_enabled": downloads_are_enabled(), "changed": changed}), 200
     except Exception as e:
-        logger.error(f"Error checking downloads state: {str(e)}")
-        return jsonify({"downloads_enabled": True})
+        logger.error(f"Error saving downloads state: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -101,14 +332,7 @@ def upload_file():
     try:
         # Check if downloads are enabled by checking the local state
         try:
-            if os.path.exists("downloads_state.json"):
-                with open("downloads_state.json", "r") as f:
-                    state = json.load(f)
-                    downloads_enabled = state.get("downloads_enabled", True)
-            else:
-                downloads_enabled = True
-                
-            if not downloads_enabled:
+            if not downloads_are_enabled():
                 logger.info("Downloads are disabled, rejecting file upload")
                 return jsonify({'message': 'Downloads are currently disabled'}), 403
         except Exception as e:
@@ -126,69 +350,8 @@ def upload_file():
         file.save(file_path)
         logger.info(f"Successfully saved file to: {os.path.abspath(file_path)}")
         
-        # Check if it's a zip file and extract it
-        if file.filename.lower().endswith('.zip'):
-            try:
-                import zipfile
-                import shutil
-                
-                # Create a temporary directory for extraction
-                temp_dir = os.path.join(UPLOAD_FOLDER, f"temp_extract_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-                os.makedirs(temp_dir, exist_ok=True)
-                
-                # Extract the zip file
-                with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                
-                # Track newly extracted files
-                extracted_files = []
-                
-                # Move extracted files to their final location
-                for root, dirs, files in os.walk(temp_dir):
-                    for dir_name in dirs:
-                        src_dir = os.path.join(root, dir_name)
-                        dst_dir = os.path.join(UPLOAD_FOLDER, os.path.relpath(src_dir, temp_dir))
-                        os.makedirs(dst_dir, exist_ok=True)
-                    
-                    for file_name in files:
-                        src_file = os.path.join(root, file_name)
-                        dst_file = os.path.join(UPLOAD_FOLDER, os.path.relpath(src_file, temp_dir))
-                        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
-                        shutil.move(src_file, dst_file)
-                        extracted_files.append(os.path.relpath(dst_file, UPLOAD_FOLDER))
-                
-                # Clean up
-                shutil.rmtree(temp_dir)
-                os.remove(file_path)  # Remove the original zip file
-                
-                # Write file received event only for newly extracted files
-                for extracted_file in extracted_files:
-                    write_event({
-                        'type': 'file_received',
-                        'filename': extracted_file,
-                        'timestamp': datetime.now().isoformat(),
-                        'is_extracted': True  # Add flag to indicate this is from extraction
-                    })
-                
-                return jsonify({'message': 'Zip file extracted successfully'}), 200
-                
-            except Exception as e:
-                logger.error(f"Error extracting zip file: {str(e)}")
-                # If extraction fails, keep the zip file
-                write_event({
-                    'type': 'file_received',
-                    'filename': file.filename,
-                    'timestamp': datetime.now().isoformat()
-                })
-                return jsonify({'message': 'File uploaded successfully (extraction failed)'}), 200
-        
-        # Write file received event for non-zip files
-        write_event({
-            'type': 'file_received',
-            'filename': file.filename,
-            'timestamp': datetime.now().isoformat()
-        })
-        
+        # Answer before unpacking, the sender's read timeout shouldn't have to cover it
+        process_received_file_later(file_path, file.filename)
         return jsonify({'message': 'File uploaded successfully'}), 200
     except Exception as e:
         logger.error(f"Error saving file: {str(e)}")
@@ -196,33 +359,772 @@ def upload_file():
         logger.error(f"Attempted to save to: {os.path.abspath(file_path)}")
         return jsonify({'error': f"Failed to upload file: {str(e)}"}), 500
 
-@app.route('/check_events', methods=['GET'])
-def check_events():
-    """Check for new file events."""
+# Relay distribution
+# A streamed upload can carry an X-Relay-Peers header listing peers the
+# receiver should pass the file on to (see relay.py). With relay_enabled in
+# the config the receiver splits that list into subtrees and forwards each
+# chunk to the head of every subtree while it is still arriving, so a
+# broadcast travels down a tree instead of leaving the sender N times. Heads
+# too old to relay get the file by multipart upload once it is complete.
+# The response reports how every peer reached fared; the sender finds
+# another way to the rest.
+def relay_upload(ip, filename, subtree, body):
+    """Send a file to one relay child, handing it its subtree; returns {ip: status} for all of them.
+
+    A child too old for streamed uploads is reported as 'legacy'.
+    """
     try:
-        if not os.path.exists(EVENT_FILE):
-            logger.info("No event file found")
-            return jsonify({'events': []}), 200
-            
-        with open(EVENT_FILE, 'r') as f:
-            events = json.load(f)
-            logger.info(f"Returning events: {events}")
-            print(f"Returning events: {events}")
+        response = peer_client.put(
+            f"http://{ip}:{PORT}/upload_stream/{quote(filename)}",
+            data=body,
+            headers={
+                'Content-Type': 'application/octet-stream',
+                'X-Relay-Peers': ','.join(subtree)
+            },
+            timeout=RELAY_TIMEOUT
+        )
+        if response.status_code == 403:
+            return {ip: 'skipped'}
+        if response.status_code == 404:
+            # Older peers only know the multipart /upload endpoint
+            return {ip: 'legacy'}
+        if response.status_code != 200:
+            logger.error(f"Relay to {ip} failed: {response.status_code} {response.text}")
+            return {ip: 'failed'}
+        results = {ip: 'sent'}
+        results.update(response.json().get('relay_results', {}))
+        return results
+    except Exception as e:
+        logger.error(f"Relay to {ip} failed: {str(e)}")
+        return {ip: 'failed'}
+
+def relay_legacy_upload(ip, filename, file_path):
+    """Send a file that is already on disk to an older peer through its multipart /upload; returns its status."""
+    try:
+        with open(file_path, 'rb') as f:
+            response = peer_client.post(
+                f"http://{ip}:{PORT}/upload",
+                files={'file': (filename, f)},
+                timeout=RELAY_TIMEOUT
+            )
+        if response.status_code == 403:
+            return 'skipped'
+        if response.status_code != 200:
+            logger.error(f"Legacy upload to {ip} failed: {response.status_code} {response.text}")
+            return 'failed'
+        return 'sent'
+    except Exception as e:
+        logger.error(f"Legacy upload to {ip} failed: {str(e)}")
+        return 'failed'
+
+class RelayQueueReader:
+    """File-like request body fed from a queue of chunks, for relaying to one child."""
+    def __init__(self, chunks, size, aborted):
+        self.chunks = chunks
+        self.size = size
+        self.aborted = aborted
+
+    def read(self, size=-1):
+        while True:
+            try:
+                chunk = self.chunks.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if self.aborted.is_set():
+                    chunk = None
+                    break
+        if self.aborted.is_set():
+            # Fail the child's request rather than end its body short
+            raise IOError("Relayed upload was aborted")
+        return chunk if chunk is not None else b''
+
+    def __iter__(self):
+        return iter(lambda: self.read(), b'')
+
+    def __len__(self):
+        return self.size
+
+class RelayStream:
+    """Wraps an incoming upload stream and copies every chunk read to the relay children."""
+    def __init__(self, stream, filename, peers, size):
+        self.stream = stream
+        self.children = []
+        for ip, subtree in split_relay_peers(peers):
+            child = {
+                'ip': ip,
+                'subtree': subtree,
+                'chunks': queue.Queue(maxsize=RELAY_QUEUE_DEPTH),
+                'done': threading.Event(),
+                'aborted': threading.Event(),
+                'results': None
+            }
+            def run(child=child):
+                try:
+                    body = RelayQueueReader(child['chunks'], size, child['aborted'])
+                    if size is None:
+                        # Chunked upload, so relay it chunked as well
+                        body = iter(body)
+                    child['results'] = relay_upload(child['ip'], filename, child['subtree'], body)
+                finally:
+                    child['done'].set()
+            child['thread'] = threading.Thread(target=run, daemon=True)
+            child['thread'].start()
+            self.children.append(child)
+
+    def feed(self, chunk):
+        """Queue a chunk (None for the end) for every child still uploading."""
+        for child in self.children:
+            # Waits for slow children, but never for one that has given up
+            while not child['done'].is_set():
+                try:
+                    child['chunks'].put(chunk, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.feed(chunk if chunk else None)
+        return chunk
+
+    def finish(self, file_path, filename):
+        """Wait for the children and upload from disk to any too old to relay; returns {ip: status}.
+
+        Subtrees whose head didn't relay are left out, for the sender to seed again.
+        """
+        results = {}
+        for child in self.children:
+            child['done'].wait()
+            child_results = dict(child['results'])
+            if child_results[child['ip']] == 'legacy':
+                child_results[child['ip']] = relay_legacy_upload(child['ip'], filename, file_path)
+            results.update(child_results)
+        return results
+
+    def abort(self):
+        """Cut the children off after the incoming upload failed."""
+        for child in self.children:
+            child['aborted'].set()
+            child['done'].set()
+            # Make room for the end marker so a child waiting on the queue wakes up now
+            while True:
+                try:
+                    child['chunks'].get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                child['chunks'].put_nowait(None)
+            except queue.Full:
+                pass
+
+@app.route('/upload_stream/<path:filename>', methods=['PUT', 'POST'])
+def upload_stream(filename):
+    """Handle streamed uploads of a raw request body, without a size cap."""
+    file_path = None
+    try:
+        try:
+            if not downloads_are_enabled():
+                logger.info("Downloads are disabled, rejecting streamed upload")
+                return jsonify({'message': 'Downloads are currently disabled'}), 403
+        except Exception as e:
+            logger.error(f"Error checking downloads status: {str(e)}")
+            return jsonify({'error': 'Failed to check downloads status'}), 500
+
+        file_path = resolve_upload_path(filename)
+        if file_path is None:
+            return jsonify({'error': 'Access denied'}), 403
+
+        # Without a length or chunked encoding we can't tell where the body ends
+        if request.content_length is None and not request.environ.get('wsgi.input_terminated'):
+            return jsonify({'error': 'Content-Length or chunked transfer encoding required'}), 411
+
+        ensure_upload_folder()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # Read straight from the WSGI input, bypassing MAX_CONTENT_LENGTH and form parsing
+        stream = get_input_stream(request.environ, max_content_length=None)
+        # Only pass files on for others when this machine has opted in to relaying
+        relay_peers = parse_relay_peers(request.headers.get('X-Relay-Peers')) if load_config().get('relay_enabled', False) else []
+        relay = None
+        if relay_peers:
+            # Pass the chunks on down the relay tree while they arrive
+            relay_name = os.path.relpath(file_path, UPLOAD_FOLDER).replace(os.sep, '/')
+            logger.info(f"Relaying {relay_name} on to {len(relay_peers)} peers")
+            relay = stream = RelayStream(stream, relay_name, relay_peers, request.content_length)
+        logger.info(f"Streaming upload to: {os.path.abspath(file_path)}")
+        try:
+            bytes_written = write_stream_to_file(stream, file_path)
+        except Exception:
+            if relay:
+                relay.abort()
+            raise
+        logger.info(f"Successfully streamed {bytes_written} bytes to: {os.path.abspath(file_path)}")
+
+        relay_results = relay.finish(file_path, relay_name) if relay else None
+        # Answer before unpacking, the sender's read timeout shouldn't have to cover it
+        process_received_file_later(file_path, os.path.relpath(file_path, UPLOAD_FOLDER))
+        body = {'message': 'File uploaded successfully'}
+        if relay_results is not None:
+            body['relay_results'] = relay_results
+        return jsonify(body), 200
+    except Exception as e:
+        logger.error(f"Error streaming file: {str(e)}")
+        if file_path:
+            logger.error(f"Attempted to save to: {os.path.abspath(file_path)}")
+        return jsonify({'error': f"Failed to upload file: {str(e)}"}), 500
+
+def extract_zip_batch(zip_path, batch):
+    """Extract a batch of zip members straight to their final paths."""
+    # Each worker gets its own handle so reads and inflation run in parallel
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info, dst_file in batch:
+            with zip_ref.open(info) as src:
+                write_stream_to_file(src, dst_file)
+
+def extract_zip_upload(zip_path):
+    """Extract a zip into the upload folder with no staging directory."""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+    
+    # Create the directory tree first so workers only ever write files
+    jobs = []
+    for info in infos:
+        dst_file = resolve_upload_path(info.filename)
+        if dst_file is None:
+            logger.warning(f"Skipping zip member outside the upload folder: {info.filename}")
+            continue
+        if info.is_dir():
+            os.makedirs(dst_file, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        jobs.append((info, dst_file))
+    
+    if len(jobs) < ZIP_EXTRACT_PARALLEL_MIN_MEMBERS or ZIP_EXTRACT_WORKERS < 2:
+        extract_zip_batch(zip_path, jobs)
+    else:
+        # Deal the biggest members out first so the batches end up about even
+        jobs.sort(key=lambda job: job[0].file_size, reverse=True)
+        batches = [jobs[i::ZIP_EXTRACT_WORKERS] for i in range(ZIP_EXTRACT_WORKERS)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ZIP_EXTRACT_WORKERS) as executor:
+            for future in [executor.submit(extract_zip_batch, zip_path, batch) for batch in batches]:
+                future.result()
+    
+    return [os.path.relpath(dst_file, UPLOAD_FOLDER) for _, dst_file in jobs]
+
+def process_received_file(file_path, filename):
+    """Extract received zip files and notify Streamlit about the new file(s)."""
+    # Check if it's a zip file and extract it
+    if filename.lower().endswith('.zip'):
+        try:
+            extracted_files = extract_zip_upload(file_path)
+            os.remove(file_path)  # Remove the original zip file
             
-        # Clear the event file after reading
-        with open(EVENT_FILE, 'w') as f:
-            json.dump([], f)
+            # Write file received event only for newly extracted files
+            write_events([{
+                'type': 'file_received',
+                'filename': extracted_file,
+                'timestamp': datetime.now().isoformat(),
+                'is_extracted': True  # Add flag to indicate this is from extraction
+            } for extracted_file in extracted_files])
+            return
             
-        return jsonify({'events': events}), 200
+        except Exception as e:
+            logger.error(f"Error extracting zip file: {str(e)}")
+            # If extraction fails, keep the zip file
+            write_event({
+                'type': 'file_received',
+                'filename': filename,
+                'timestamp': datetime.now().isoformat()
+            })
+            return
+    
+    # Write file received event for non-zip files
+    write_event({
+        'type': 'file_received',
+        'filename': filename,
+        'timestamp': datetime.now().isoformat()
+    })
+
+def process_received_file_later(file_path, filename):
+    """Run process_received_file on a thread of its own, so the sender isn't kept waiting on an extraction."""
+    def run():
+        try:
+            process_received_file(file_path, filename)
+        except Exception as e:
+            logger.error(f"Error processing received file {filename}: {str(e)}")
+    threading.Thread(target=run, daemon=True).start()
+
+def extract_tar_stream(stream, compression=None):
+    """Unpack a tar stream into the upload folder member by member as it arrives."""
+    if compression == 'zstd':
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        mode = 'r|'
+    else:
+        # Plain, gzip, bz2 and xz are recognised from the stream itself
+        mode = 'r|*'
+    
+    extracted_files = []
+    with tarfile.open(fileobj=stream, mode=mode, bufsize=STREAM_CHUNK_SIZE) as tar:
+        for member in tar:
+            dst_file = resolve_upload_path(member.name)
+            if dst_file is None:
+                logger.warning(f"Skipping tar member outside the upload folder: {member.name}")
+                continue
+            if member.isdir():
+                os.makedirs(dst_file, exist_ok=True)
+                continue
+            if not member.isfile():
+                # Links and device files have no business in a file drop
+                logger.warning(f"Skipping non-regular tar member: {member.name}")
+                continue
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+            write_stream_to_file(tar.extractfile(member), dst_file)
+            try:
+                os.utime(dst_file, (member.mtime, member.mtime))
+            except OSError:
+                pass
+            extracted_files.append(os.path.relpath(dst_file, UPLOAD_FOLDER))
+    return extracted_files
+
+@app.route('/upload_tar', methods=['PUT', 'POST'])
+def upload_tar():
+    """Receive a folder, or a batch of files, as a (optionally compressed) tar stream, extracting while it arrives."""
+    try:
+        try:
+            if not downloads_are_enabled():
+                logger.info("Downloads are disabled, rejecting tar upload")
+                return jsonify({'message': 'Downloads are currently disabled'}), 403
+        except Exception as e:
+            logger.error(f"Error checking downloads status: {str(e)}")
+            return jsonify({'error': 'Failed to check downloads status'}), 500
+        
+        compression = request.args.get('compression')
+        if compression == 'zstd' and not ZSTD_AVAILABLE:
+            return jsonify({'error': 'zstd is not supported by this receiver'}), 415
+        if request.content_length is None and not request.environ.get('wsgi.input_terminated'):
+            return jsonify({'error': 'Content-Length or chunked transfer encoding required'}), 411
+        
+        ensure_upload_folder()
+        stream = get_input_stream(request.environ, max_content_length=None)
+        extracted_files = extract_tar_stream(stream, compression)
+        logger.info(f"Extracted {len(extracted_files)} files from tar stream")
+        
+        if request.args.get('batch') == '1':
+            # A batch of small files is reported as one event, not one per file
+            write_event({
+                'type': 'files_received',
+                'filenames': extracted_files,
+                'timestamp': datetime.now().isoformat()
+            })
+        else:
+            write_events([{
+                'type': 'file_received',
+                'filename': extracted_file,
+                'timestamp': datetime.now().isoformat(),
+                'is_extracted': True
+            } for extracted_file in extracted_files])
+        
+        return jsonify({'message': 'Tar stream extracted successfully', 'files': len(extracted_files)}), 200
+    except Exception as e:
+        logger.error(f"Error extracting tar stream: {str(e)}")
+        return jsonify({'error': f"Failed to extract tar stream: {str(e)}"}), 500
+
+# Resumable upload sessions
+# Each session keeps a small JSON record in UPLOAD_SESSION_DIR and its data in a
+# hidden .part file next to the final destination, so finalizing is a rename.
+# The committed offset is simply the size of the .part file.
+# Striped sessions preallocate the .part file instead and take chunks at any
+# offset over several connections at once; they record the byte ranges that
+# have arrived and commit the file as soon as those cover all of it.
+upload_session_locks = {}
+upload_session_locks_lock = threading.Lock()
+completed_upload_sessions = {}  # session id -> filename of recently committed striped sessions
+
+def remember_completed_session(session):
+    """Note that a striped session was committed, for late duplicate chunks to find."""
+    completed_upload_sessions[session['session_id']] = session['filename']
+    while len(completed_upload_sessions) > COMPLETED_SESSIONS_KEPT:
+        completed_upload_sessions.pop(next(iter(completed_upload_sessions)), None)
+
+def completed_session_response(session_id):
+    """Answer for a chunk of a striped session that has already been committed."""
+    return jsonify({'session_id': session_id, 'complete': True, 'message': 'File received'}), 200
+
+def get_upload_session_lock(session_id):
+    """Get the lock serializing writes to one upload session."""
+    with upload_session_locks_lock:
+        if session_id not in upload_session_locks:
+            upload_session_locks[session_id] = threading.Lock()
+        return upload_session_locks[session_id]
+
+def upload_session_file(session_id):
+    """Get the path of an upload session's state file."""
+    return os.path.join(UPLOAD_SESSION_DIR, f"{session_id}.json")
+
+def load_upload_session(session_id):
+    """Load an upload session's state, or None if it doesn't exist."""
+    # Session ids are generated by us, anything else is not a valid session
+    try:
+        uuid.UUID(hex=session_id)
+    except ValueError:
+        return None
+    try:
+        with open(upload_session_file(session_id), 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def save_upload_session(session):
+    """Persist an upload session's state."""
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    session_file = upload_session_file(session['session_id'])
+    with open(session_file + '.tmp', 'w') as f:
+        json.dump(session, f)
+    os.replace(session_file + '.tmp', session_file)
+
+def remove_upload_session(session, remove_data=True):
+    """Remove an upload session's state and, optionally, its partial data."""
+    paths = [upload_session_file(session['session_id'])]
+    if remove_data:
+        paths.append(session['part_path'])
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    with upload_session_locks_lock:
+        upload_session_locks.pop(session['session_id'], None)
+
+def get_committed_offset(session):
+    """Get how many bytes of an upload session have reached the disk."""
+    if session.get('striped'):
+        # Only the gap-free start of a striped file counts
+        received = session['received']
+        return received[0][1] if received and received[0][0] == 0 else 0
+    try:
+        return os.path.getsize(session['part_path'])
+    except OSError:
+        return 0
+
+def cleanup_stale_upload_sessions():
+    """Remove upload sessions that haven't been touched for UPLOAD_SESSION_TTL."""
+    if not os.path.isdir(UPLOAD_SESSION_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(UPLOAD_SESSION_DIR):
+        if not name.endswith('.json'):
+            continue
+        session = load_upload_session(name[:-len('.json')])
+        if session and now - session.get('updated', 0) > UPLOAD_SESSION_TTL:
+            logger.info(f"Removing stale upload session {session['session_id']} for {session['filename']}")
+            remove_upload_session(session)
+
+@app.route('/upload_session', methods=['POST'])
+def create_upload_session():
+    """Start a resumable upload session."""
+    try:
+        if not downloads_are_enabled():
+            logger.info("Downloads are disabled, rejecting upload session")
+            return jsonify({'message': 'Downloads are currently disabled'}), 403
+
+        data = request.get_json(silent=True) or {}
+        filename = data.get('filename')
+        size = data.get('size')
+        if not filename or not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'filename and size are required'}), 400
+        striped = data.get('striped') is True and size > 0
+
+        file_path = resolve_upload_path(filename)
+        if file_path is None:
+            return jsonify({'error': 'Access denied'}), 403
+
+        cleanup_stale_upload_sessions()
+        ensure_upload_folder()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        session_id = uuid.uuid4().hex
+        session = {
+            'session_id': session_id,
+            'filename': os.path.relpath(file_path, UPLOAD_FOLDER),
+            'file_path': file_path,
+            'part_path': os.path.join(
+                os.path.dirname(file_path),
+                f".{os.path.basename(file_path)}.{session_id}.part"
+            ),
+            'size': size,
+            'created': time.time(),
+            'updated': time.time()
+        }
+        if striped:
+            session.update(striped=True, received=[])
+            preallocate_file(session['part_path'], size)
+        else:
+            open(session['part_path'], 'wb').close()
+        save_upload_session(session)
+        logger.info(f"Created {'striped ' if striped else ''}upload session {session_id} for {session['filename']} ({size} bytes)")
+
+        return jsonify({'session_id': session_id, 'offset': 0, 'size': size, 'striped': striped}), 201
+    except Exception as e:
+        logger.error(f"Error creating upload session: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload_session/<session_id>', methods=['GET'])
+def get_upload_session(session_id):
+    """Report how many bytes of an upload session have been committed."""
+    session = load_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify({
+        'session_id': session_id,
+        'filename': session['filename'],
+        'offset': get_committed_offset(session),
+        'size': session['size'],
+        'received': session.get('received')
+    }), 200
+
+@app.route('/upload_session/<session_id>', methods=['PUT'])
+def put_upload_chunk(session_id):
+    """Append a chunk to an upload session at the given offset."""
+    session = load_upload_session(session_id)
+    if session is None:
+        if session_id in completed_upload_sessions:
+            # A retried or duplicate chunk from after the file was committed
+            return completed_session_response(session_id)
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'offset is required'}), 400
+    if session.get('striped'):
+        return put_striped_chunk(session, offset)
+    if request.content_length is None and not request.environ.get('wsgi.input_terminated'):
+        return jsonify({'error': 'Content-Length or chunked transfer encoding required'}), 411
+
+    lock = get_upload_session_lock(session_id)
+    if not lock.acquire(blocking=False):
+        return jsonify({'error': 'Another chunk is being written to this session'}), 409
+    try:
+        committed = get_committed_offset(session)
+        if offset != committed:
+            # Tell the sender where to continue from
+            return jsonify({'error': 'Offset mismatch', 'offset': committed}), 409
+        if request.content_length is not None and committed + request.content_length > session['size']:
+            return jsonify({'error': 'Chunk runs past the end of the file', 'offset': committed}), 400
+
+        stream = get_input_stream(request.environ, max_content_length=None)
+        with open(session['part_path'], 'ab') as f:
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+        session['updated'] = time.time()
+        save_upload_session(session)
+        return jsonify({'session_id': session_id, 'offset': get_committed_offset(session), 'size': session['size']}), 200
+    except Exception as e:
+        # Whatever reached the disk stays committed, the sender resumes from there
+        logger.error(f"Error writing chunk for upload session {session_id}: {str(e)}")
+        return jsonify({'error': str(e), 'offset': get_committed_offset(session)}), 500
+    finally:
+        lock.release()
+
+def preallocate_file(file_path, size):
+    """Create file_path at its full size so chunks can be written at their own offsets."""
+    with open(file_path, 'wb') as f:
+        try:
+            # Reserve the blocks now so a full disk fails the session, not a late chunk
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+def write_at(f, data, offset):
+    """Write data at offset without moving a shared file position."""
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # No pwrite on Windows, every request has its own handle so seeking is safe
+        f.seek(offset)
+        f.write(data)
+
+def add_received_range(received, start, end):
+    """Merge [start, end) into a sorted list of disjoint received ranges."""
+    merged = []
+    for range_start, range_end in sorted(received + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def put_striped_chunk(session, offset):
+    """Write a chunk of a striped session in place, committing the file once all of it is there."""
+    session_id = session['session_id']
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Content-Length required'}), 411
+    if offset < 0 or offset + length > session['size']:
+        return jsonify({'error': 'Chunk runs past the end of the file'}), 400
+
+    try:
+        # Stripes write side by side, each at its own offset
+        stream = get_input_stream(request.environ, max_content_length=None)
+        position = offset
+        with open(session['part_path'], 'r+b', buffering=0) as f:
+            while position < offset + length:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, offset + length - position))
+                if not chunk:
+                    break
+                write_at(f, chunk, position)
+                position += len(chunk)
+        if position != offset + length:
+            return jsonify({'error': 'Chunk was cut short', 'received': session['received']}), 400
+
+        with get_upload_session_lock(session_id):
+            # Other stripes may have recorded ranges since this request loaded the session
+            session = load_upload_session(session_id)
+            if session is None:
+                if session_id in completed_upload_sessions:
+                    return completed_session_response(session_id)
+                return jsonify({'error': 'Upload session not found'}), 404
+            session['received'] = add_received_range(session['received'], offset, offset + length)
+            session['updated'] = time.time()
+            complete = session['received'] == [[0, session['size']]]
+            if complete:
+                os.replace(session['part_path'], session['file_path'])
+                remove_upload_session(session, remove_data=False)
+                remember_completed_session(session)
+            else:
+                save_upload_session(session)
+    except FileNotFoundError:
+        if session_id in completed_upload_sessions:
+            # Another stripe committed the file while this chunk was on its way
+            return completed_session_response(session_id)
+        logger.error(f"Upload session {session_id} lost its data file")
+        return jsonify({'error': 'Upload session data is missing'}), 500
+    except Exception as e:
+        # The range isn't recorded, so the sender just sends it again
+        logger.error(f"Error writing chunk for upload session {session_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    if not complete:
+        return jsonify({'session_id': session_id, 'received': session['received'], 'size': session['size']}), 200
+    logger.info(f"Striped upload session {session_id} complete: {os.path.abspath(session['file_path'])}")
+    # The sender's request timeout shouldn't have to cover unpacking the file
+    process_received_file_later(session['file_path'], session['filename'])
+    return completed_session_response(session_id)
+
+@app.route('/upload_session/<session_id>/finalize', methods=['POST'])
+def finalize_upload_session(session_id):
+    """Move a completed upload session's data into place."""
+    session = load_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    with get_upload_session_lock(session_id):
+        committed = get_committed_offset(session)
+        if committed != session['size']:
+            return jsonify({'error': 'Upload is incomplete', 'offset': committed, 'size': session['size']}), 409
+        try:
+            os.replace(session['part_path'], session['file_path'])
+            remove_upload_session(session, remove_data=False)
+        except Exception as e:
+            logger.error(f"Error finalizing upload session {session_id}: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    logger.info(f"Finalized upload session {session_id} to: {os.path.abspath(session['file_path'])}")
+    # Answer before any extraction, so the sender's finalize doesn't time out on a big archive
+    process_received_file_later(session['file_path'], session['filename'])
+    return jsonify({'message': 'File uploaded successfully'}), 200
+
+@app.route('/upload_session/<session_id>', methods=['DELETE'])
+def abort_upload_session(session_id):
+    """Abort an upload session and discard its partial data."""
+    session = load_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    with get_upload_session_lock(session_id):
+        remove_upload_session(session)
+    return jsonify({'message': 'Upload session aborted'}), 200
+
+@app.route('/check_events', methods=['GET'])
+def check_events():
+    """Check for new file events.
+    
+    With ?since=N this returns the events after sequence number N and leaves
+    the journal alone. Without it, events are consumed through the shared
+    default cursor, so each one is handed out once.
+    """
+    try:
+        since = request.args.get('since', type=int)
+        if since is None:
+            events = consume_events()
+        else:
+            events = read_events(since)
+        cursor = events[-1]['seq'] if events else max(since or 0, get_last_event_seq())
+        if events:
+            logger.info(f"Returning {len(events)} events up to {cursor}")
+        return jsonify({'events': events, 'cursor': cursor}), 200
     except Exception as e:
         logger.error(f"Error checking events: {str(e)}")
         print(f"Error checking events: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/events/wait', methods=['GET'])
+def wait_for_events():
+    """Long-poll for file events, answering as soon as there is something new.
+    
+    Reads after ?since=N, or through the named cursor of ?consumer=NAME so a
+    subscriber gets each event once, even across restarts. With neither it
+    just returns the current cursor.
+    """
+    try:
+        since = request.args.get('since', type=int)
+        consumer = request.args.get('consumer')
+        if since is None and consumer is None:
+            return jsonify({'events': [], 'cursor': get_last_event_seq()}), 200
+        
+        timeout = min(request.args.get('timeout', EVENT_WAIT_TIMEOUT, type=float), EVENT_WAIT_MAX_TIMEOUT)
+        deadline = time.time() + timeout
+        while True:
+            with event_condition:
+                generation = event_generation
+            events = consume_events(consumer) if consumer else read_events(since)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                break
+            with event_condition:
+                if event_generation == generation:
+                    event_condition.wait(timeout=remaining)
+        
+        cursor = events[-1]['seq'] if events else max(since or 0, get_last_event_seq())
+        return jsonify({'events': events, 'cursor': cursor}), 200
+    except Exception as e:
+        logger.error(f"Error waiting for events: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint."""
-    return jsonify({'status': 'healthy'}), 200
+    """Health check endpoint, also saying which tar stream compressions we unpack."""
+    return jsonify({
+        'status': 'healthy',
+        'tar_compressions': ['none', 'gzip', 'bz2', 'xz'] + (['zstd'] if ZSTD_AVAILABLE else [])
+    }), 200
+
+@app.route('/identity', methods=['GET'])
+def identity():
+    """Tell a network scan who we are, so it needs no other request to list us."""
+    return jsonify({
+        'app': 'SharedInit',
+        'hostname': socket.gethostname(),
+        'platform': platform.system(),
+        'platform_release': platform.release(),
+        'downloads_enabled': downloads_are_enabled()
+    }), 200
 
 @app.route('/update_config', methods=['POST'])
 def update_config():
@@ -257,6 +1159,375 @@ def update_config():
         logger.error(f"Error updating configuration: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Streaming zip archives
+# Folder downloads are written as a zip stream on the fly. Every member uses a
+# data descriptor, so its CRC and sizes follow the data and nothing needs to be
+# seeked back to. Header sizes only depend on names and file sizes, which lets
+# store-only archives announce an exact Content-Length up front.
+def zip_dos_datetime(mtime):
+    """Convert a timestamp to the DOS (time, date) pair used in zip headers."""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1  # 1980-01-01, the earliest DOS date
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def zip_member_uses_zip64(size):
+    """Check whether a member needs zip64 sizes (same margin zipfile uses)."""
+    return size * 1.05 > zipfile.ZIP64_LIMIT
+
+def zip_local_header(member, method):
+    """Build the local file header for a member."""
+    zip64 = zip_member_uses_zip64(member['size'])
+    extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+    placeholder = 0xFFFFFFFF if zip64 else 0
+    return struct.pack(
+        '<4sHHHHHLLLHH',
+        b'PK\x03\x04',
+        45 if zip64 else 20,  # Version needed to extract
+        0x0808,  # Data descriptor follows, UTF-8 names
+        method,
+        member['dos_time'],
+        member['dos_date'],
+        0,  # CRC, in the data descriptor
+        placeholder,
+        placeholder,
+        len(member['name']),
+        len(extra)
+    ) + member['name'] + extra
+
+def zip_data_descriptor(member, crc, compress_size):
+    """Build the data descriptor that follows a member's data."""
+    if zip_member_uses_zip64(member['size']):
+        return struct.pack('<4sLQQ', b'PK\x07\x08', crc, compress_size, member['size'])
+    return struct.pack('<4sLLL', b'PK\x07\x08', crc, compress_size, member['size'])
+
+def zip_central_header(member, method, crc, compress_size, header_offset):
+    """Build the central directory entry for a member."""
+    zip64_fields = []
+    file_size = member['size']
+    if file_size > zipfile.ZIP64_LIMIT:
+        zip64_fields.append(file_size)
+        file_size = 0xFFFFFFFF
+    if compress_size > zipfile.ZIP64_LIMIT:
+        zip64_fields.append(compress_size)
+        compress_size = 0xFFFFFFFF
+    if header_offset > zipfile.ZIP64_LIMIT:
+        zip64_fields.append(header_offset)
+        header_offset = 0xFFFFFFFF
+    extra = b''
+    if zip64_fields:
+        extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+    version = 45 if zip64_fields or zip_member_uses_zip64(member['size']) else 20
+    return struct.pack(
+        '<4sBBHHHHHLLLHHHHHLL',
+        b'PK\x01\x02',
+        version,
+        3,  # Made by: Unix, so external attributes carry the mode
+        version,
+        0x0808,
+        method,
+        member['dos_time'],
+        member['dos_date'],
+        crc,
+        compress_size,
+        file_size,
+        len(member['name']),
+        len(extra),
+        0,  # Comment length
+        0,  # Disk number
+        0,  # Internal attributes
+        (0o100644 << 16),  # External attributes: regular file, rw-r--r--
+        header_offset
+    ) + member['name'] + extra
+
+def zip_end_records(entry_count, central_size, central_offset):
+    """Build the end of central directory record(s)."""
+    records = b''
+    if (entry_count >= zipfile.ZIP_FILECOUNT_LIMIT or central_size > zipfile.ZIP64_LIMIT
+            or central_offset > zipfile.ZIP64_LIMIT):
+        zip64_end_offset = central_offset + central_size
+        records += struct.pack(
+            '<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0,
+            entry_count, entry_count, central_size, central_offset
+        )
+        records += struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end_offset, 1)
+        entry_count = min(entry_count, 0xFFFF)
+        central_size = min(central_size, 0xFFFFFFFF)
+        central_offset = min(central_offset, 0xFFFFFFFF)
+    records += struct.pack(
+        '<4sHHHHLLH', b'PK\x05\x06', 0, 0,
+        entry_count, entry_count, central_size, central_offset, 0
+    )
+    return records
+
+def list_zip_members(folder_path, base_folder):
+    """List every file under folder_path with its archive name, size and timestamp."""
+    members = []
+    for root, dirs, files in os.walk(folder_path):
+        dirs.sort()
+        for file in sorted(files):
+            file_full_path = os.path.join(root, file)
+            try:
+                stat = os.stat(file_full_path)
+            except OSError:
+                continue
+            # Get the relative path for the file in the zip
+            arcname = os.path.relpath(file_full_path, base_folder).replace(os.sep, '/')
+            dos_time, dos_date = zip_dos_datetime(stat.st_mtime)
+            members.append({
+                'path': file_full_path,
+                'name': arcname.encode('utf-8'),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'dos_time': dos_time,
+                'dos_date': dos_date
+            })
+    return members
+
+def stored_zip_size(members):
+    """Compute the exact size of a store-only archive of members."""
+    total = 0
+    central_size = 0
+    for member in members:
+        header_offset = total
+        total += len(zip_local_header(member, zipfile.ZIP_STORED))
+        total += member['size']
+        total += len(zip_data_descriptor(member, 0, member['size']))
+        central_size += len(zip_central_header(member, zipfile.ZIP_STORED, 0, member['size'], header_offset))
+    return total + central_size + len(zip_end_records(len(members), central_size, total))
+
+def zip_content_disposition(download_name):
+    """Build an attachment Content-Disposition header that survives non-ASCII names."""
+    try:
+        download_name.encode('ascii')
+        return f'attachment; filename="{download_name}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(download_name)}"
+
+def load_compression_policy():
+    """Load the folder archive compression policy, with config overrides."""
+    policy = dict(DEFAULT_COMPRESSION_POLICY)
+    policy.update(load_config().get('compression_policy', {}))
+    policy['store_extensions'] = {ext.lower().lstrip('.') for ext in policy['store_extensions']}
+    policy['deflate_extensions'] = {ext.lower().lstrip('.') for ext in policy['deflate_extensions']}
+    return policy
+
+def sample_entropy(sample):
+    """Get the Shannon entropy of a byte sample, in bits per byte."""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(
+        (count / total) * math.log2(count / total)
+        for count in Counter(sample).values()
+    )
+
+def assign_zip_methods(members, mode, policy):
+    """Pick store or deflate for each member, leaving None where the content must be sampled."""
+    for member in members:
+        if mode == 'store':
+            member['method'] = zipfile.ZIP_STORED
+        elif mode == 'deflate':
+            member['method'] = zipfile.ZIP_DEFLATED
+        else:
+            extension = os.path.splitext(member['path'])[1].lower().lstrip('.')
+            if member['size'] < policy['min_deflate_size']:
+                member['method'] = zipfile.ZIP_STORED
+            elif extension in policy['store_extensions']:
+                member['method'] = zipfile.ZIP_STORED
+            elif extension in policy['deflate_extensions']:
+                member['method'] = zipfile.ZIP_DEFLATED
+            else:
+                member['method'] = None
+
+def choose_sampled_method(first_block, policy):
+    """Pick store or deflate from the entropy of a member's first block."""
+    sample = first_block[:COMPRESSION_SAMPLE_SIZE]
+    if sample_entropy(sample) >= policy['entropy_threshold']:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def stream_zip(members, policy=None, stats=None):
+    """Yield a zip archive of members, sending each one as soon as it is read."""
+    if stats is None:
+        stats = {}
+    stats.update({'members': len(members), 'stored': 0, 'deflated': 0, 'sampled': 0, 'bytes_in': 0, 'bytes_out': 0})
+    started = time.time()
+    offset = 0
+    central_directory = []
+    for member in members:
+        with open(member['path'], 'rb') as f:
+            # Read exactly the size we listed, the headers were built from it
+            remaining = member['size']
+            chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            method = member.get('method')
+            if method is None:
+                method = choose_sampled_method(chunk, policy or DEFAULT_COMPRESSION_POLICY)
+                stats['sampled'] += 1
+            stats['stored' if method == zipfile.ZIP_STORED else 'deflated'] += 1
+            
+            header_offset = offset
+            header = zip_local_header(member, method)
+            yield header
+            offset += len(header)
+            
+            crc = 0
+            compress_size = 0
+            compressor = zlib.compressobj(ZIP_DEFLATE_LEVEL, zlib.DEFLATED, -15) if method == zipfile.ZIP_DEFLATED else None
+            while remaining > 0:
+                if not chunk:
+                    raise IOError(f"{member['path']} shrank while it was being archived")
+                remaining -= len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    compress_size += len(chunk)
+                    yield chunk
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining)) if remaining > 0 else b''
+        if compressor:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            yield chunk
+        offset += compress_size
+        stats['bytes_in'] += member['size']
+        stats['bytes_out'] += compress_size
+        
+        descriptor = zip_data_descriptor(member, crc, compress_size)
+        yield descriptor
+        offset += len(descriptor)
+        central_directory.append(zip_central_header(member, method, crc, compress_size, header_offset))
+    
+    central_directory = b''.join(central_directory)
+    yield central_directory
+    yield zip_end_records(len(members), len(central_directory), offset)
+    
+    stats['seconds'] = round(time.time() - started, 3)
+    archive_stats.append(stats)
+    logger.info(
+        f"Archived {stats.get('folder', 'folder')}: {stats['members']} members "
+        f"({stats['stored']} stored, {stats['deflated']} deflated, {stats['sampled']} sampled), "
+        f"{stats['bytes_in']} -> {stats['bytes_out']} bytes in {stats['seconds']}s"
+    )
+
+# Folder archive cache
+# Finished archives are kept in ARCHIVE_CACHE_DIR under a fingerprint of
+# everything that shapes their bytes: member names, sizes, mtimes and the
+# compression settings. A changed folder gets a new fingerprint, so entries
+# never go stale; they just age out. Hits update the access time only, so
+# the ETag stays stable for ranged resumes, and eviction is LRU on atime.
+def get_archive_cache_budget():
+    """Get the archive cache size budget in bytes (0 disables the cache)."""
+    return int(load_config().get('archive_cache_max_bytes', DEFAULT_ARCHIVE_CACHE_MAX_BYTES))
+
+def archive_fingerprint(folder_path, members, mode, policy):
+    """Fingerprint a folder archive by its member list and compression settings."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        'folder': os.path.abspath(folder_path),
+        'mode': mode,
+        'policy': {key: sorted(value) if isinstance(value, set) else value for key, value in policy.items()},
+        'level': ZIP_DEFLATE_LEVEL
+    }, sort_keys=True).encode())
+    for member in members:
+        digest.update(member['name'] + b'\0')
+        digest.update(f"{member['size']}:{member['mtime_ns']}\n".encode())
+    return digest.hexdigest()
+
+def get_cached_archive(fingerprint):
+    """Get the path of a cached archive and mark it as recently used, or None."""
+    cache_path = os.path.join(ARCHIVE_CACHE_DIR, f"{fingerprint}.zip")
+    try:
+        stat = os.stat(cache_path)
+        os.utime(cache_path, ns=(time.time_ns(), stat.st_mtime_ns))
+        return cache_path
+    except OSError:
+        return None
+
+def evict_archive_cache(budget):
+    """Delete least recently used archives until the cache fits its budget."""
+    if not os.path.isdir(ARCHIVE_CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(ARCHIVE_CACHE_DIR):
+        if not name.endswith('.zip'):
+            continue
+        path = os.path.join(ARCHIVE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_atime_ns, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f"Evicted cached archive {os.path.basename(path)} ({size} bytes)")
+        except OSError:
+            pass
+
+def cache_archive_stream(chunks, fingerprint, budget):
+    """Pass archive chunks through while saving a copy into the archive cache."""
+    cache_path = os.path.join(ARCHIVE_CACHE_DIR, f"{fingerprint}.zip")
+    temp_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+    cache_file = None
+    try:
+        os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+        cache_file = open(temp_path, 'wb')
+    except OSError as e:
+        logger.warning(f"Not caching archive {fingerprint}: {str(e)}")
+    try:
+        for chunk in chunks:
+            if cache_file:
+                try:
+                    cache_file.write(chunk)
+                except OSError as e:
+                    # A full cache disk shouldn't break the download itself
+                    logger.warning(f"Stopped caching archive {fingerprint}: {str(e)}")
+                    cache_file.close()
+                    cache_file = None
+                    os.remove(temp_path)
+            yield chunk
+        if cache_file:
+            cache_file.close()
+            cache_file = None
+            os.replace(temp_path, cache_path)
+            evict_archive_cache(budget)
+    finally:
+        # Client went away or the archive failed, drop the partial copy
+        if cache_file:
+            cache_file.close()
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+def send_file_with_ranges(file_path, download_name=None):
+    """Send a file with Range, If-Range and conditional GET support."""
+    # A multi-range request would need a multipart/byteranges body, which
+    # werkzeug answers with 416. Ignoring Range and sending the whole file
+    # is allowed by RFC 9110, so do that instead.
+    if request.range is not None and len(request.range.ranges) > 1:
+        request.environ.pop('HTTP_RANGE', None)
+    return send_file(
+        file_path,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=True,
+        max_age=None
+    )
+
+@app.route('/archive_stats', methods=['GET'])
+def get_archive_stats():
+    """Report compression stats for the most recent folder archives."""
+    return jsonify({'archives': list(archive_stats)}), 200
+
 @app.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
     """Download a file or folder."""
@@ -276,49 +1547,62 @@ def download_file(filename):
             logger.error(f"File/folder not found: {file_path}")
             return jsonify({'error': 'File or folder not found'}), 404
             
-        # If it's a directory, create a zip file
+        # If it's a directory, stream it as a zip archive
         if os.path.isdir(file_path):
-            import tempfile
-            import zipfile
+            mode = request.args.get('compression', 'auto')
+            if mode not in ('auto', 'store', 'deflate'):
+                return jsonify({'error': f'Unknown compression mode: {mode}'}), 400
+            policy = load_compression_policy()
+            members = list_zip_members(file_path, app.config['UPLOAD_FOLDER'])
+            assign_zip_methods(members, mode, policy)
+            download_name = f"{os.path.basename(file_path)}.zip"
             
-            # Create a temporary zip file
-            temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-            with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # Walk through the directory
-                for root, dirs, files in os.walk(file_path):
-                    for file in files:
-                        file_full_path = os.path.join(root, file)
-                        # Get the relative path for the file in the zip
-                        arcname = os.path.relpath(file_full_path, app.config['UPLOAD_FOLDER'])
-                        zipf.write(file_full_path, arcname)
+            budget = get_archive_cache_budget()
+            fingerprint = archive_fingerprint(file_path, members, mode, policy) if budget > 0 else None
+            cached_path = get_cached_archive(fingerprint) if fingerprint else None
+            if cached_path:
+                logger.info(f"Serving {download_name} from the archive cache")
+                return send_file_with_ranges(cached_path, download_name)
             
-            # Send the zip file
-            response = send_from_directory(
-                os.path.dirname(temp_zip.name),
-                os.path.basename(temp_zip.name),
-                as_attachment=True,
-                download_name=f"{os.path.basename(filename)}.zip"
-            )
-            
-            # Clean up the temporary file after sending
-            @response.call_on_close
-            def cleanup():
-                try:
-                    os.unlink(temp_zip.name)
-                except:
-                    pass
-                    
+            stats = {'folder': os.path.relpath(file_path, app.config['UPLOAD_FOLDER']), 'mode': mode}
+            chunks = stream_zip(members, policy, stats)
+            if fingerprint and sum(member['size'] for member in members) <= budget:
+                chunks = cache_archive_stream(chunks, fingerprint, budget)
+            response = Response(chunks, mimetype='application/zip')
+            response.headers['Content-Disposition'] = zip_content_disposition(download_name)
+            if all(member['method'] == zipfile.ZIP_STORED for member in members):
+                # Store-only archives have a size we can work out before sending
+                response.headers['Content-Length'] = str(stored_zip_size(members))
             return response
         else:
-            # For regular files, send as before
-            directory = os.path.dirname(file_path)
-            filename = os.path.basename(file_path)
-            return send_from_directory(directory, filename, as_attachment=True)
+            return send_file_with_ranges(file_path)
+    except HTTPException:
+        # Let Flask answer 304 / 412 / 416 from conditional and range handling
+        raise
     except Exception as e:
         logger.error(f"Error sending file/folder {filename}: {str(e)}")
         return jsonify({'error': f'Failed to download file/folder: {str(e)}'}), 500
 
+def receive_multicast_file(file_path, filename):
+    """Hand a file that arrived by multicast to the normal received-file handling."""
+    process_received_file(file_path, os.path.relpath(file_path, UPLOAD_FOLDER))
+
+def run_multicast_receiver():
+    """Take multicast transfers for as long as the server runs."""
+    try:
+        MulticastReceiver(
+            resolve_path=lambda filename: resolve_upload_path(filename),
+            accepting=downloads_are_enabled,
+            on_complete=receive_multicast_file,
+            interface=load_config().get('multicast_interface')
+        ).run()
+    except Exception as e:
+        # No multicast route on this machine, senders fall back to HTTP
+        logger.error(f"Multicast receiver stopped: {str(e)}")
+
 if __name__ == '__main__':
     ensure_upload_folder()
+    threading.Thread(target=run_event_compaction, daemon=True).start()
+    threading.Thread(target=run_multicast_receiver, daemon=True).start()
     logger.info(f"Starting Flask server on port {PORT}")
     app.run(host='0.0.0.0', port=PORT) 
\ No newline at end of file
@@ -0,0 +1,425 @@
+"""UDP multicast bulk transfers with NACK based repair.
+
+The sender announces a transfer to a multicast group, sends the file once
+as numbered blocks and then repeats an end marker. Each receiver tracks
+which blocks it has and answers the end marker with a NACK listing the
+block ranges it is missing, which the sender re-multicasts so every
+receiver that lost the same blocks is repaired at once. A receiver that
+has everything answers with an ACK. Sender bandwidth is the same no
+matter how many receivers listen. Every control message lists the
+addresses the file is for, and other receivers on the group ignore it.
+
+Control messages (announce, end, nack, ack) are small JSON datagrams;
+data blocks are a binary header followed by the payload. app.py sends,
+file_server.py receives, and both ends work on loopback for testing.
+"""
+import socket
+import struct
+import json
+import os
+import time
+import uuid
+import random
+import select
+import shutil
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Constants
+MULTICAST_GROUP = "239.255.77.77"  # Administratively scoped, stays on the LAN
+MULTICAST_PORT = 8503
+MULTICAST_TTL = 1  # Never leave the local segment
+MULTICAST_BLOCK_SIZE = 1400  # Payload per datagram, keeps packets under a 1500 byte MTU
+MULTICAST_RATE = 40 * 1024 * 1024  # Bytes per second the sender paces itself to
+MULTICAST_SOCKET_BUFFER = 4 * 1024 * 1024  # Kernel buffer asked for on both ends
+MULTICAST_END_INTERVAL = 0.2  # Seconds between end markers while waiting for NACKs
+MULTICAST_IDLE_ENDS = 15  # End markers without any NACK before the sender gives up on the rest
+MULTICAST_MAX_REPAIR_ROUNDS = 50  # Repair passes before the sender gives up
+MULTICAST_NACK_RANGES = 128  # Most missing ranges listed in one NACK
+MULTICAST_NACK_JITTER = 0.05  # Receivers spread their NACKs over this many seconds
+MULTICAST_TRANSFER_TTL = 60  # Seconds an unfinished receive may sit idle before it is dropped
+
+DATA_MAGIC = b'SIMD'
+DATA_HEADER = struct.Struct('!4s16sI')  # magic, transfer id, block index
+
+def block_count(size, block_size=MULTICAST_BLOCK_SIZE):
+    """Number of blocks a file of size bytes is split into."""
+    return -(-size // block_size)
+
+def missing_ranges(received, limit=MULTICAST_NACK_RANGES):
+    """Turn a received-blocks bitmap into up to limit [first, last] ranges of missing blocks."""
+    ranges = []
+    start = None
+    for index, have in enumerate(received):
+        if not have and start is None:
+            start = index
+        elif have and start is not None:
+            ranges.append([start, index - 1])
+            start = None
+            if len(ranges) >= limit:
+                return ranges
+    if start is not None:
+        ranges.append([start, len(received) - 1])
+    return ranges
+
+def open_sender_socket(interface=None):
+    """UDP socket for sending to the group and reading NACKs and ACKs."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MULTICAST_SOCKET_BUFFER)
+    if interface:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+def send_datagram(sock, data, address):
+    """sendto on a non-blocking socket, waiting for room whenever the send buffer is full."""
+    while True:
+        try:
+            return sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            # The link is slower than the pace we asked for, let the kernel catch up
+            select.select([], [sock], [], MULTICAST_END_INTERVAL)
+
+def local_addresses(interface=None):
+    """IPv4 addresses this machine may be listed under in a transfer's recipients."""
+    addresses = {interface} if interface else set()
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            addresses.add(s.getsockname()[0])
+        finally:
+            s.close()
+    except OSError:
+        pass
+    try:
+        addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    except OSError:
+        pass
+    return addresses
+
+def send_file_multicast(file_path, peers, filename=None, interface=None, group=MULTICAST_GROUP,
+                        port=MULTICAST_PORT, rate=MULTICAST_RATE, progress=None, cancelled=None):
+    """Multicast a file to peers and repair whatever they miss.
+
+    file_path may also be an in-memory file with name, size and open().
+    peers are the addresses expected to answer, and the only receivers that
+    take the file. progress is called with the
+    bytes sent in the first pass. Returns {peer: status} where status is
+    'sent', 'skipped' (downloads disabled) or 'failed'; a receiver that never
+    answered shows up as 'failed' so the caller can fall back to unicast.
+    """
+    transfer_id = uuid.uuid4()
+    in_memory = hasattr(file_path, 'open')
+    size = file_path.size if in_memory else os.path.getsize(file_path)
+    blocks = block_count(size)
+    control = {
+        'id': transfer_id.hex,
+        'filename': filename or (file_path.name if in_memory else os.path.basename(file_path)),
+        'size': size,
+        'block_size': MULTICAST_BLOCK_SIZE,
+        'recipients': sorted(peers)
+    }
+    expected = set(peers)
+    results = {}
+    to_send = range(blocks)
+    sock = open_sender_socket(interface)
+
+    def send_control(message_type):
+        send_datagram(sock, json.dumps(dict(control, type=message_type)).encode(), (group, port))
+
+    def read_replies():
+        """Collect waiting NACKs and ACKs; returns the blocks asked for again."""
+        wanted = set()
+        while True:
+            try:
+                data, addr = sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return wanted
+            try:
+                message = json.loads(data.decode())
+            except ValueError:
+                continue
+            if message.get('id') != transfer_id.hex:
+                continue
+            peer = message.get('ip') or addr[0]
+            if message.get('type') == 'ack':
+                results[peer] = message.get('status', 'sent')
+            elif message.get('type') == 'nack' and peer not in results:
+                for first, last in message.get('ranges', []):
+                    wanted.update(range(max(first, 0), min(last, blocks - 1) + 1))
+
+    try:
+        for _ in range(3):
+            send_control('announce')
+
+        with (file_path.open() if in_memory else open(file_path, 'rb')) as f:
+            rounds = 0
+            first_pass = True
+            while True:
+                started = time.time()
+                sent_bytes = 0
+                position = None
+                for count, index in enumerate(to_send):
+                    if cancelled is not None and cancelled.is_set():
+                        raise IOError("Multicast send was cancelled")
+                    offset = index * MULTICAST_BLOCK_SIZE
+                    if position != offset:
+                        f.seek(offset)
+                    payload = f.read(MULTICAST_BLOCK_SIZE)
+                    position = offset + len(payload)
+                    send_datagram(sock, DATA_HEADER.pack(DATA_MAGIC, transfer_id.bytes, index) + payload, (group, port))
+                    sent_bytes += len(payload)
+
+                    # Pace to the configured rate so switches and receivers don't drop the burst
+                    ahead = sent_bytes / rate - (time.time() - started)
+                    if ahead > 0.005:
+                        time.sleep(ahead)
+                    if count % 256 == 255:
+                        if first_pass and progress:
+                            progress(sent_bytes)
+                        # Only ACKs matter mid-pass, NACKs get asked for again after it
+                        read_replies()
+                if first_pass and progress:
+                    progress(size)
+                first_pass = False
+
+                # Keep asking for NACKs until someone wants something or everyone is done
+                wanted = set()
+                idle_ends = 0
+                while not expected.issubset(results) and idle_ends < MULTICAST_IDLE_ENDS:
+                    if cancelled is not None and cancelled.is_set():
+                        raise IOError("Multicast send was cancelled")
+                    send_control('end')
+                    time.sleep(MULTICAST_END_INTERVAL)
+                    wanted = read_replies()
+                    if wanted:
+                        break
+                    idle_ends += 1
+
+                rounds += 1
+                if not wanted or rounds > MULTICAST_MAX_REPAIR_ROUNDS:
+                    break
+                logger.info(f"Multicast repair round {rounds}: resending {len(wanted)} blocks")
+                to_send = sorted(wanted)
+    finally:
+        sock.close()
+
+    for peer in expected:
+        results.setdefault(peer, 'failed')
+    return results
+
+class MulticastReceiver:
+    """Listens on the multicast group and writes announced files to disk.
+
+    resolve_path(filename) returns where a file should end up, or None to
+    refuse it. accepting() says whether files are being taken at all.
+    on_complete(path, filename) runs on a thread of its own once a file has
+    been fully received and moved into place, so slow post-processing
+    doesn't hold up other transfers. Transfers whose recipients don't
+    include one of this machine's addresses, or name, are ignored.
+    """
+    def __init__(self, resolve_path, accepting, on_complete, interface=None,
+                 group=MULTICAST_GROUP, port=MULTICAST_PORT, name=None):
+        self.resolve_path = resolve_path
+        self.accepting = accepting
+        self.on_complete = on_complete
+        self.interface = interface
+        self.group = group
+        self.port = port
+        self.name = name  # Reported instead of our address in replies, for loopback tests
+        self.transfers = {}
+        self.finished = {}
+        self.addresses = set()
+        self.sock = None
+        self.stopped = threading.Event()
+
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_SOCKET_BUFFER)
+        sock.bind(('', self.port))
+        membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface or '0.0.0.0')
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.settimeout(1)
+        return sock
+
+    def reply(self, addr, message):
+        if self.name:
+            message['ip'] = self.name
+        try:
+            self.sock.sendto(json.dumps(message).encode(), addr)
+        except OSError as e:
+            logger.warning(f"Could not answer multicast sender {addr[0]}: {str(e)}")
+
+    def run(self):
+        """Receive until stop() is called."""
+        self.sock = self.open_socket()
+        self.addresses = {self.name} if self.name else local_addresses(self.interface)
+        logger.info(f"Listening for multicast transfers on {self.group}:{self.port}")
+        last_sweep = time.time()
+        try:
+            while not self.stopped.is_set():
+                if time.time() - last_sweep > MULTICAST_TRANSFER_TTL / 4:
+                    self.drop_stale()
+                    if not self.name:
+                        # Addresses change when a laptop moves between networks
+                        self.addresses = local_addresses(self.interface)
+                    last_sweep = time.time()
+                try:
+                    data, addr = self.sock.recvfrom(65536)
+                except socket.timeout:
+                    continue
+                try:
+                    if data.startswith(DATA_MAGIC):
+                        self.handle_block(data)
+                    else:
+                        self.handle_control(json.loads(data.decode()), addr)
+                except Exception as e:
+                    logger.error(f"Error handling multicast packet from {addr[0]}: {str(e)}")
+        finally:
+            self.sock.close()
+            for transfer in list(self.transfers.values()):
+                self.discard(transfer)
+
+    def stop(self):
+        self.stopped.set()
+
+    def handle_control(self, message, addr):
+        transfer_id = message.get('id')
+        if transfer_id in self.finished:
+            # The sender missed our ACK
+            self.reply(addr, {'type': 'ack', 'id': transfer_id, 'status': self.finished[transfer_id]})
+            return
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            if not self.addresses.intersection(message.get('recipients') or ()):
+                # Sent to other devices on the group, not to us
+                return
+            transfer = self.start_transfer(message, addr)
+            if transfer is None:
+                return
+        transfer['seen'] = time.time()
+        if message.get('type') == 'end':
+            ranges = missing_ranges(transfer['received'])
+            if not ranges:
+                self.complete(transfer, addr)
+            else:
+                # Spread NACKs out so a room full of receivers doesn't answer at once
+                time.sleep(random.uniform(0, MULTICAST_NACK_JITTER))
+                self.reply(addr, {'type': 'nack', 'id': transfer_id, 'ranges': ranges})
+
+    def start_transfer(self, message, addr):
+        transfer_id = message['id']
+        if not self.accepting():
+            self.finish(transfer_id, 'skipped', addr)
+            return None
+        file_path = self.resolve_path(message['filename'])
+        if file_path is None or message.get('block_size') != MULTICAST_BLOCK_SIZE:
+            self.finish(transfer_id, 'failed', addr)
+            return None
+        size = message.get('size')
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            self.finish(transfer_id, 'failed', addr)
+            return None
+        temp_path = None
+        f = None
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            if size > shutil.disk_usage(os.path.dirname(file_path)).free:
+                raise IOError(f"{size} bytes won't fit in the free disk space")
+            temp_path = os.path.join(
+                os.path.dirname(file_path),
+                f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.part"
+            )
+            f = open(temp_path, 'wb')
+            f.truncate(size)
+            transfer = {
+                'id': transfer_id,
+                'filename': message['filename'],
+                'path': file_path,
+                'temp_path': temp_path,
+                'file': f,
+                'uuid': uuid.UUID(transfer_id).bytes,
+                'received': bytearray(block_count(size)),
+                'seen': time.time()
+            }
+        except Exception as e:
+            logger.error(f"Can't receive {message.get('filename')} by multicast from {addr[0]}: {str(e)}")
+            if f is not None:
+                f.close()
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            self.finish(transfer_id, 'failed', addr)
+            return None
+        self.transfers[transfer_id] = transfer
+        # Data blocks carry the raw id, control messages the hex one
+        self.transfers[transfer['uuid']] = transfer
+        logger.info(f"Receiving {message['filename']} ({size} bytes) by multicast from {addr[0]}")
+        return transfer
+
+    def handle_block(self, data):
+        _, raw_id, index = DATA_HEADER.unpack_from(data)
+        transfer = self.transfers.get(raw_id)
+        if transfer is None or index >= len(transfer['received']) or transfer['received'][index]:
+            return
+        transfer['file'].seek(index * MULTICAST_BLOCK_SIZE)
+        transfer['file'].write(data[DATA_HEADER.size:])
+        transfer['received'][index] = 1
+        transfer['seen'] = time.time()
+
+    def complete(self, transfer, addr):
+        self.forget(transfer)
+        transfer['file'].close()
+        try:
+            os.replace(transfer['temp_path'], transfer['path'])
+            status = 'sent'
+        except Exception as e:
+            logger.error(f"Error finishing multicast receive of {transfer['filename']}: {str(e)}")
+            status = 'failed'
+        self.finish(transfer['id'], status, addr)
+        if status == 'sent':
+            # Unpacking a zip can take a while, the receive loop has other transfers to serve
+            threading.Thread(target=self.run_on_complete, args=(transfer,), daemon=True).start()
+
+    def run_on_complete(self, transfer):
+        try:
+            self.on_complete(transfer['path'], transfer['filename'])
+        except Exception as e:
+            logger.error(f"Error handling multicast receive of {transfer['filename']}: {str(e)}")
+
+    def finish(self, transfer_id, status, addr):
+        self.finished[transfer_id] = status
+        self.reply(addr, {'type': 'ack', 'id': transfer_id, 'status': status})
+
+    def forget(self, transfer):
+        self.transfers.pop(transfer['id'], None)
+        self.transfers.pop(transfer['uuid'], None)
+
+    def discard(self, transfer):
+        self.forget(transfer)
+        transfer['file'].close()
+        try:
+            os.remove(transfer['temp_path'])
+        except OSError:
+            pass
+
+    def drop_stale(self):
+        """Give up on receives whose sender went quiet, and forget old results."""
+        now = time.time()
+        for transfer in list(self.transfers.values()):
+            if now - transfer['seen'] > MULTICAST_TRANSFER_TTL:
+                logger.warning(f"Multicast receive of {transfer['filename']} stalled, dropping it")
+                self.discard(transfer)
+        if len(self.finished) > 1000:
+            self.finished.clear()
@@ -0,0 +1,212 @@
+"""Asynchronous LAN sweep for other SharedInit instances.
+
+Every candidate address gets a non-blocking connect to its file server
+port at the same time (up to SCAN_CONCURRENCY in flight), and each host
+that answers is asked for its identity in a single GET /identity, so a
+whole /24 takes about one SCAN_TIMEOUT. Results come back as a stream
+while the sweep runs. Used by app.py and the pages from ordinary threads;
+the event loop lives on a thread of its own.
+
+Networks are sized from the interface netmask rather than assumed to be
+a /24, and the OS neighbour (ARP) table names the addresses worth trying
+first. Connect round trips seen along the way give a tighter connect
+timeout for the rest of a large network.
+"""
+import asyncio
+import ipaddress
+import json
+import os
+import queue
+import re
+import socket
+import subprocess
+import threading
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# psutil gives the real interface netmask, without it a /24 is assumed
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# Constants
+SCAN_PORT = 8502  # File server port, which answers /identity
+SCAN_CONCURRENCY = 256  # Probes in flight at once, kept under the usual 256+ open file limit
+SCAN_CONNECT_TIMEOUT = 0.5  # Seconds to wait for a connect before calling the address empty
+SCAN_TIMEOUT = 1.0  # Seconds one probe may take in all, identity reply included
+IDENTITY_MAX_BYTES = 64 * 1024  # Largest /identity reply read
+SCAN_MIN_CONNECT_TIMEOUT = 0.1  # Shortest connect timeout the adaptive timeout goes down to
+SCAN_RTT_FACTOR = 4  # Adaptive connect timeout as a multiple of the usual round trip seen
+SCAN_DEFAULT_PREFIX = 24  # Network size assumed when the netmask can't be read
+SCAN_MIN_PREFIX = 20  # Wider networks are only swept in the /20 around this machine
+ARP_TABLE = "/proc/net/arp"  # Linux neighbour table
+
+def local_network(local_ip):
+    """The network local_ip is on, going by its interface netmask."""
+    prefix = SCAN_DEFAULT_PREFIX
+    if PSUTIL_AVAILABLE:
+        try:
+            for addresses in psutil.net_if_addrs().values():
+                for address in addresses:
+                    if address.family == socket.AF_INET and address.address == local_ip and address.netmask:
+                        prefix = ipaddress.ip_network(f"0.0.0.0/{address.netmask}").prefixlen
+        except Exception as e:
+            logger.warning(f"Could not read the netmask of {local_ip}: {str(e)}")
+    return ipaddress.ip_interface(f"{local_ip}/{max(prefix, SCAN_MIN_PREFIX)}").network
+
+def read_neighbor_table():
+    """Addresses the OS neighbour table has a link layer address for."""
+    ips = []
+    try:
+        if os.path.exists(ARP_TABLE):
+            with open(ARP_TABLE, 'r') as f:
+                next(f, None)  # Column headings
+                for line in f:
+                    fields = line.split()
+                    # Flags 0x0 is an incomplete entry, nothing answered there
+                    if len(fields) >= 3 and fields[2] != '0x0':
+                        ips.append(fields[0])
+        else:
+            # Windows and macOS list the same table through arp -a
+            output = subprocess.run(['arp', '-a'], capture_output=True, text=True, timeout=2).stdout
+            for line in output.splitlines():
+                if 'incomplete' in line or 'Interface:' in line:
+                    continue
+                ips.extend(re.findall(r'\b\d{1,3}(?:\.\d{1,3}){3}\b', line)[:1])
+    except Exception as e:
+        logger.warning(f"Could not read the neighbour table: {str(e)}")
+    return ips
+
+def neighbor_ips(network):
+    """Hosts of network the OS has recently talked to, in table order."""
+    hosts = []
+    for ip in read_neighbor_table():
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        if address in network and address not in (network.network_address, network.broadcast_address) and ip not in hosts:
+            hosts.append(ip)
+    return hosts
+
+def adaptive_connect_timeout(rtts):
+    """Connect timeout for addresses nobody is known at, from the round trips seen to live hosts."""
+    if not rtts:
+        return SCAN_CONNECT_TIMEOUT
+    # A high percentile, so one slow host doesn't set the pace for the whole sweep
+    usual = sorted(rtts)[int(len(rtts) * 0.9)]
+    return min(max(usual * SCAN_RTT_FACTOR, SCAN_MIN_CONNECT_TIMEOUT), SCAN_CONNECT_TIMEOUT)
+
+def describe_host(ip, identity):
+    """Turn an /identity reply into the connection dict the UI shows."""
+    downloads_enabled = identity.get('downloads_enabled')
+    host = {
+        "ip": ip,
+        "hostname": identity.get('hostname') or ip,
+        "status": "Online",
+        "last_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": identity.get('platform') or "Unknown",
+        "downloads_enabled": "Unknown" if downloads_enabled is None else ("Enabled" if downloads_enabled else "Disabled")
+    }
+    if downloads_enabled is not None:
+        # As good as a presence beacon for how current the downloads state is
+        host["reported"] = time.time()
+    return host
+
+def parse_identity(raw):
+    """Pull the JSON body out of a raw HTTP/1.0 /identity response, or None if it isn't one of us."""
+    if not raw.startswith(b'HTTP/'):
+        return None
+    head, _, body = raw.partition(b'\r\n\r\n')
+    status_line = head.split(b'\r\n', 1)[0].split()
+    if len(status_line) < 2 or status_line[1] != b'200':
+        return None
+    try:
+        identity = json.loads(body.decode())
+    except ValueError:
+        return None
+    if not isinstance(identity, dict) or identity.get('app') != 'SharedInit':
+        # Some other web server that happens to be on our port
+        return None
+    return identity
+
+async def probe_host(ip, port, semaphore, connect_timeout, timeout, on_connect=None):
+    """Connect to ip and ask for its identity; returns (ip, host dict or None).
+
+    on_connect(ip, seconds) is called with the connect round trip of every
+    host that answered, whether it accepted the connection or refused it.
+    """
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + timeout
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+        except ConnectionRefusedError:
+            # Nothing listens there, but the host is up and the refusal took one round trip
+            if on_connect:
+                on_connect(ip, loop.time() - started)
+            return ip, None
+        except (OSError, asyncio.TimeoutError):
+            return ip, None
+        if on_connect:
+            on_connect(ip, loop.time() - started)
+        identity = None
+        try:
+            writer.write(f"GET /identity HTTP/1.0\r\nHost: {ip}:{port}\r\n\r\n".encode())
+            await writer.drain()
+            # HTTP/1.0 means the server closes the connection once the reply is out
+            raw = await asyncio.wait_for(reader.read(IDENTITY_MAX_BYTES), max(deadline - loop.time(), 0.05))
+            while raw and len(raw) < IDENTITY_MAX_BYTES:
+                more = await asyncio.wait_for(reader.read(IDENTITY_MAX_BYTES - len(raw)), max(deadline - loop.time(), 0.05))
+                if not more:
+                    break
+                raw += more
+            identity = parse_identity(raw)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+        # Something took the connection but isn't a SharedInit server
+        return ip, None if identity is None else describe_host(ip, identity)
+
+async def scan_hosts(ips, port=SCAN_PORT, concurrency=SCAN_CONCURRENCY,
+                     connect_timeout=SCAN_CONNECT_TIMEOUT, timeout=SCAN_TIMEOUT, on_connect=None):
+    """Probe every ip at once, yielding (ip, host dict or None) as each probe finishes."""
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = [probe_host(ip, port, semaphore, connect_timeout, timeout, on_connect) for ip in ips]
+    for probe in asyncio.as_completed(probes):
+        yield await probe
+
+def iter_scan(ips, **kwargs):
+    """Run scan_hosts on a background event loop and yield its results from this thread."""
+    results = queue.Queue()
+
+    async def collect():
+        async for result in scan_hosts(ips, **kwargs):
+            results.put(result)
+
+    def run():
+        try:
+            asyncio.run(collect())
+        except Exception as e:
+            results.put(e)
+        results.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        result = results.get()
+        if result is None:
+            return
+        if isinstance(result, Exception):
+            raise result
+        yield result
+
+def scan(ips, **kwargs):
+    """Probe ips and return the hosts found."""
+    return [host for _, host in iter_scan(ips, **kwargs) if host is not None]
@@ -1,19 +1,11 @@
 import streamlit as st
 import socket
-import ipaddress
-import concurrent.futures
-from datetime import datetime
-import requests
-import json
+from discovery import get_discovery_service, get_network_range
+from peer_registry import get_peer_registry, sync_active_connections
 import platform
-import subprocess
-import time
-import threading
-import queue
 
 # Constants
-PORT = 8501  # Streamlit default port
-APP_IDENTIFIER = "LAN-FILE-SHARING-APP"  # Unique identifier for our app
+PORT = 8501  # Streamlit default port, linked to by "Open Connection"
 
 # Initialize session state for active connections if not exists
 if 'active_connections' not in st.session_state:
@@ -31,156 +23,35 @@ def get_local_ip():
         st.warning(f"Could not determine local IP: {str(e)}")
         return "127.0.0.1"
 
-def get_network_range():
-    """Get the network range based on local IP."""
-    local_ip = get_local_ip()
-    ip_parts = local_ip.split('.')
-    return f"{ip_parts[0]}.{ip_parts[1]}.{ip_parts[2]}.0/24"
-
-def check_app_instance(ip):
-    """Check if a host is running our Streamlit app."""
-    try:
-        # Try to connect to the Streamlit port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(0.5)  # 500ms timeout for each connection attempt
-        result = sock.connect_ex((ip, PORT))
-        sock.close()
-        
-        if result == 0:
-            # Try multiple methods to get hostname
-            hostname = None
-            try:
-                # Method 1: Try reverse DNS lookup
-                hostname = socket.gethostbyaddr(ip)[0]
-            except:
-                try:
-                    # Method 2: Try to get hostname from the device
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(0.5)
-                    sock.connect((ip, PORT))
-                    sock.send(b"GET /_stcore/stream HTTP/1.1\r\nHost: " + ip.encode() + b"\r\n\r\n")
-                    response = sock.recv(1024).decode()
-                    sock.close()
-                    
-                    # Look for hostname in response headers
-                    for line in response.split('\n'):
-                        if 'X-Hostname:' in line:
-                            hostname = line.split('X-Hostname:')[1].strip()
-                            break
-                except:
-                    pass
-            
-            # If hostname is still None, use IP as hostname
-            if not hostname:
-                hostname = ip
-            
-            # Try to detect platform
-            platform_type = "Unknown"
-            try:
-                # Try multiple endpoints to get platform info
-                endpoints = [
-                    f"http://{ip}:{PORT}/_stcore/health",
-                    f"http://{ip}:{PORT}/_stcore/stream",
-                    f"http://{ip}:{PORT}"
-                ]
-                
-                for endpoint in endpoints:
-                    try:
-                        response = requests.get(endpoint, timeout=0.5)
-                        if response.status_code == 200:
-                            # Check all possible platform headers
-                            platform_type = (
-                                response.headers.get('X-Platform') or
-                                response.headers.get('X-Platform-Version') or
-                                response.headers.get('X-Platform-Machine') or
-                                'Unknown'
-                            )
-                            if platform_type != 'Unknown':
-                                break
-                    except:
-                        continue
-                
-                # If still unknown, try to detect from hostname
-                if platform_type == "Unknown":
-                    try:
-                        # Try to detect platform from hostname patterns
-                        hostname_lower = hostname.lower()
-                        if 'mac' in hostname_lower or 'darwin' in hostname_lower:
-                            platform_type = "Darwin"
-                        elif 'win' in hostname_lower:
-                            platform_type = "Windows"
-                        elif 'linux' in hostname_lower:
-                            platform_type = "Linux"
-                    except:
-                        pass
-            except:
-                pass
-
-            # Check downloads state
-            downloads_enabled = "Unknown"
-            try:
-                response = requests.post(
-                    f"http://{ip}:8502/downloads_enabled",
-                    json={'downloads_enabled': True},
-                    headers={'Content-Type': 'application/json'},
-                    timeout=0.5
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    downloads_enabled = "Enabled" if data.get('downloads_enabled', False) else "Disabled"
-            except:
-                pass
-            
-            return {
-                "ip": ip,
-                "hostname": hostname,
-                "status": "Online",
-                "last_seen": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "platform": platform_type,
-                "downloads_enabled": downloads_enabled
-            }
-    except:
-        pass
-    return None
-
-def scan_network():
-    """Scan the network for other instances of our app."""
-    network = ipaddress.ip_network(get_network_range())
-    active_hosts = []
-    
-    # Get local IP to exclude it from scanning
-    local_ip = get_local_ip()
-    
-    # Get list of IPs to scan (excluding local IP)
-    ips_to_scan = [str(ip) for ip in network.hosts() if str(ip) != local_ip]
-    total_ips = len(ips_to_scan)
+def refresh_peers():
+    """Scan the network, or follow a scan already running, and show what is known after it."""
+    service = get_discovery_service()
+    service.request_scan(min_interval=0)
     
     # Create progress bar
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-        future_to_ip = {
-            executor.submit(check_app_instance, ip): ip 
-            for ip in ips_to_scan
-        }
-        
-        scanned = 0
-        for future in concurrent.futures.as_completed(future_to_ip):
-            scanned += 1
-            progress = scanned / total_ips
-            progress_bar.progress(progress)
-            status_text.text(f"Scanning... {scanned}/{total_ips} IPs")
-            
-            result = future.result()
-            if result:
-                active_hosts.append(result)
+    # The scan runs on the shared service, this only shows how far it got
+    while not service.scan_done.wait(0.1):
+        scanned, total = service.progress()
+        if total:
+            progress_bar.progress(min(scanned / total, 1.0))
+            status_text.text(f"Scanning... {scanned}/{total} IPs")
     
     # Clear progress indicators
     progress_bar.empty()
     status_text.empty()
     
-    return active_hosts
+    sync_active_connections()
+
+@st.fragment(run_every=1)
+def watch_peer_registry():
+    """Rerun the page when a peer appears, drops off or changes, or the sweep finishes."""
+    service = get_discovery_service()
+    if get_peer_registry().version != st.session_state.get('peer_registry_version') or \
+            service.scanning != st.session_state.get('peer_scan_running'):
+        st.rerun(scope="app")
 
 def main():
     st.title("Connected Devices")
@@ -190,22 +61,25 @@ def main():
     st.info(f"Your local IP address: {local_ip}")
     st.info(f"Platform: {platform.system()} {platform.release()}")
     
-    # Perform initial scan if not done yet
+    # Start from the peers we already know, only scan if there are none
     if 'initial_scan_done' not in st.session_state:
-        with st.spinner("Performing initial network scan..."):
-            active_hosts = scan_network()
-            st.session_state.active_connections = {
-                host['ip']: host for host in active_hosts
-            }
-            st.session_state.initial_scan_done = True
+        sync_active_connections()
+        if not st.session_state.active_connections:
+            with st.spinner("Performing initial network scan..."):
+                refresh_peers()
+        st.session_state.initial_scan_done = True
     
     # Add a refresh button for manual updates
     if st.button("🔄 Refresh Now"):
         with st.spinner("Scanning for devices..."):
-            active_hosts = scan_network()
-            st.session_state.active_connections = {
-                host['ip']: host for host in active_hosts
-            }
+            refresh_peers()
+    else:
+        sync_active_connections()
+    
+    # Likely hosts are checked first, the rest of the network after them
+    st.session_state.peer_scan_running = get_discovery_service().scanning
+    if st.session_state.peer_scan_running:
+        st.caption(f"Still looking for devices in the rest of {get_network_range()}...")
     
     # Display active connections
     if st.session_state.active_connections:
@@ -237,6 +111,8 @@ def main():
         3. Try running the app with administrator privileges
         4. Ensure both instances are running the latest version
         """)
+    
+    watch_peer_registry()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
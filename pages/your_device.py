@@ -6,7 +6,7 @@ import os
 import json
 import shutil
 import subprocess
-import requests
+import peer_client
 
 # Constants
 PORT = 8501  # Streamlit default port
@@ -54,7 +54,7 @@ def change_download_folder(new_folder):
         
         # Notify Flask server about the configuration change
         try:
-            response = requests.post(
+            response = peer_client.post(
                 f"http://localhost:{FLASK_PORT}/update_config",
                 json={"download_folder": new_folder},
                 timeout=1
@@ -92,7 +92,7 @@ def change_max_path(new_path):
         
         # Notify Flask server about the configuration change
         try:
-            response = requests.post(
+            response = peer_client.post(
                 f"http://localhost:{FLASK_PORT}/update_config",
                 json={"max_path": new_path},
                 timeout=1
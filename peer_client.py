@@ -0,0 +1,52 @@
+"""Shared HTTP client for talking to SharedInit peers.
+
+Every probe, status check and upload goes through one pooled keep-alive
+requests.Session per peer host, so repeated calls reuse their TCP
+connections instead of opening a new one each time. Used by app.py and
+the pages, and safe to call from any thread.
+"""
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Constants
+POOL_CONNECTIONS = 4  # host:port pools per peer session (Streamlit and Flask ports)
+POOL_MAXSIZE = 16  # Kept-alive connections per host:port, enough for parallel chunks and segments
+DEFAULT_TIMEOUT = (3, 30)  # Connect and read timeouts for calls that don't pass their own
+
+peer_sessions = {}
+peer_sessions_lock = threading.Lock()
+
+def get_session(host):
+    """Return the pooled session for a peer host, creating it on first use."""
+    with peer_sessions_lock:
+        session = peer_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            peer_sessions[host] = session
+        return session
+
+def request(method, url, **kwargs):
+    """Make a request through the peer's pooled session."""
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    return get_session(urlsplit(url).hostname).request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
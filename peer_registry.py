@@ -0,0 +1,131 @@
+"""Peers this machine has seen, kept on disk between runs.
+
+Each peer's last known hostname, platform, capabilities and last-seen
+time is stored in a small JSON file, so a new session can list devices
+straight away and check them again in the background instead of
+waiting on a network sweep. Peers start out 'Unverified' until a scan
+or presence broadcast confirms them, and are forgotten after
+PEER_REGISTRY_TTL without being seen. The time a peer last reported its
+state tells callers whether they can go by it or should ask the peer.
+Used by app.py and the pages through get_peer_registry and
+sync_active_connections, so the whole process shares one registry and
+one writer of its file, and safe to call from any thread.
+"""
+import os
+import json
+import threading
+import time
+import logging
+from datetime import datetime
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+# Constants
+PEER_REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "peer_registry.json")
+PEER_REGISTRY_TTL = 7 * 24 * 60 * 60  # Forget peers not seen for a week
+PEER_REGISTRY_SAVE_INTERVAL = 30  # Seconds between saves that only move last_seen forward
+LAST_SEEN_FORMAT = "%Y-%m-%d %H:%M:%S"
+VOLATILE_KEYS = ('last_seen', 'reported', 'free_disk', 'load')  # Change on every report, not worth a save or rerun
+
+class PeerRegistry:
+    """Known peers by ip, as the connection dicts the UI shows."""
+    def __init__(self, path=PEER_REGISTRY_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.peers = self.load()
+        self.saved = time.time()
+        self.version = 0  # Moves on whenever a peer appears, disappears or changes
+
+    def load(self):
+        """Read the registry, marking every peer unverified until it is seen again."""
+        try:
+            with open(self.path, 'r') as f:
+                peers = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading peer registry: {str(e)}")
+            return {}
+        now = time.time()
+        loaded = {}
+        for ip, peer in peers.items():
+            try:
+                age = now - datetime.strptime(peer['last_seen'], LAST_SEEN_FORMAT).timestamp()
+            except (KeyError, TypeError, ValueError):
+                continue
+            if age <= PEER_REGISTRY_TTL:
+                loaded[ip] = dict(peer, status='Unverified')
+        return loaded
+
+    def save(self):
+        """Write the registry atomically. Call with the lock held."""
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.peers, f)
+            os.replace(self.path + '.tmp', self.path)
+            self.saved = time.time()
+        except Exception as e:
+            logger.error(f"Error saving peer registry: {str(e)}")
+
+    def update(self, peer):
+        """Record that a peer was just seen, merging what we learnt about it."""
+        with self.lock:
+            previous = self.peers.get(peer['ip'], {})
+            merged = dict(previous, **peer)
+            merged['status'] = 'Online'
+            merged['last_seen'] = datetime.now().strftime(LAST_SEEN_FORMAT)
+            self.peers[peer['ip']] = merged
+            # A peer that only checked in again can wait for the next periodic save
+            changed = {key: value for key, value in merged.items() if key not in VOLATILE_KEYS} != \
+                {key: value for key, value in previous.items() if key not in VOLATILE_KEYS}
+            if changed:
+                self.version += 1
+            if changed or time.time() - self.saved > PEER_REGISTRY_SAVE_INTERVAL:
+                self.save()
+
+    def mark_offline(self, ips):
+        """Mark peers that didn't answer a scan as offline."""
+        with self.lock:
+            changed = False
+            for ip in ips:
+                if ip in self.peers and self.peers[ip].get('status') != 'Offline':
+                    self.peers[ip]['status'] = 'Offline'
+                    changed = True
+            if changed:
+                self.version += 1
+                self.save()
+
+    def get(self, ip):
+        """A copy of a peer's entry, or None if it isn't known."""
+        with self.lock:
+            peer = self.peers.get(ip)
+            return dict(peer) if peer is not None else None
+
+    def fresh(self, ip, max_age):
+        """A peer's entry if it reported its state within max_age seconds, else None."""
+        with self.lock:
+            peer = self.peers.get(ip)
+            if peer is None or peer.get('status') == 'Offline' or time.time() - peer.get('reported', 0) > max_age:
+                return None
+            return dict(peer)
+
+    def known_ips(self):
+        with self.lock:
+            return list(self.peers)
+
+    def active(self):
+        """Peers that are online or not yet checked again, by ip."""
+        with self.lock:
+            return {ip: dict(peer) for ip, peer in self.peers.items() if peer.get('status') != 'Offline'}
+
+@st.cache_resource
+def get_peer_registry():
+    """The peers this machine knows about, loaded from disk once per process."""
+    return PeerRegistry()
+
+def sync_active_connections():
+    """Show this session the peers in the shared registry."""
+    registry = get_peer_registry()
+    st.session_state.peer_registry_version = registry.version
+    st.session_state.active_connections = registry.active()
@@ -0,0 +1,40 @@
+"""Relay tree helpers shared by the sender (app.py) and receivers (file_server.py).
+
+A broadcast in relay mode uploads to a few seed peers only. Each upload
+carries an X-Relay-Peers header listing the peers below that seed, and
+the receiver splits the list into subtrees and passes the file on to
+the head of each. Relaying is opt-in through relay_enabled in
+app_config.json on both ends. A receiver only ever uploads to the heads
+of its own subtrees. A head it couldn't reach is reported as failed and
+the rest of that subtree is left out of the report, so the sender seeds
+those peers again.
+"""
+import ipaddress
+
+# Constants
+RELAY_FANOUT = 2  # Peers each relaying receiver forwards a file on to
+RELAY_MAX_PEERS = 256  # Longest X-Relay-Peers list a receiver will take on
+
+def parse_relay_peers(value):
+    """Parse an X-Relay-Peers header into a list of LAN addresses."""
+    peers = []
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            address = ipaddress.ip_address(item)
+        except ValueError:
+            continue
+        # Only ever relay inside the local network
+        if (address.is_private or address.is_loopback) and item not in peers:
+            peers.append(item)
+    return peers[:RELAY_MAX_PEERS]
+
+def split_relay_peers(peers, fanout=RELAY_FANOUT):
+    """Split peers into up to fanout subtrees, as (head, rest of subtree) pairs."""
+    size = -(-len(peers) // fanout) if peers else 0
+    return [
+        (peers[start], peers[start + 1:start + size])
+        for start in range(0, len(peers), size or 1)
+    ]
@@ -0,0 +1,300 @@
+"""Durable outbound transfer queue.
+
+Every send is stored as one job per file and peer in a SQLite database, so
+pending sends survive a restart of the app. A small pool of worker threads
+claims due jobs, sending every due job for the same file together so the
+fan-out can still share one read of it, and records the outcome per peer.
+Failed jobs are retried with exponential backoff, identical pending jobs
+are only queued once, and with shortest_first the smallest files go first
+so they don't wait behind a multi-GB upload. Files sent straight from
+memory, or as a batch of files, are only held until their jobs finish,
+so they can't outlive a restart.
+"""
+import os
+import uuid
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Constants
+TRANSFER_RETRY_BASE = 5  # Seconds before the first retry, doubled for every attempt after that
+TRANSFER_RETRY_MAX = 5 * 60  # Longest wait between retries
+TRANSFER_MAX_ATTEMPTS = 8  # Attempts before a job is marked failed for good
+TRANSFER_POLL_INTERVAL = 1  # Seconds idle workers wait before looking for due retries
+TRANSFER_HISTORY = 200  # Finished jobs kept for the queue display
+
+# Outcomes of a send that are worth trying again later
+RETRYABLE_STATUSES = ('failed', 'unreachable', 'timed out')
+FINAL_STATUSES = ('sent', 'skipped', 'failed', 'removed')
+MEMORY_PREFIX = 'memory:'  # file_path of jobs whose file only exists in memory
+
+class TransferQueue:
+    """SQLite backed queue of file sends, worked off by a pool of threads.
+
+    send_batch(file_path, peers, on_update) sends one file to peers (ip to
+    hostname), calling on_update with the per-peer transfer dicts while it
+    runs, and returns {ip: status}. For anything queued other than a path
+    it gets the object that was queued.
+    """
+    def __init__(self, db_path, send_batch, workers=2, shortest_first=True):
+        self.db_path = db_path
+        self.send_batch = send_batch
+        self.workers = workers
+        self.shortest_first = shortest_first
+        self.local = threading.local()
+        self.claim_lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.active = {}  # job id -> live transfer dict of a running job
+        self.sources = {}  # memory: file_path -> in-memory file its jobs send
+        self.sources_lock = threading.Lock()
+        self.cancelled_jobs = set()
+        self.threads = []
+        self.version = 0  # Moves on whenever a job is added, claimed, finished or removed
+        self.version_lock = threading.Lock()
+        self.listed = None  # (version, limit, rows) of the last list_jobs query
+
+    def get_db(self):
+        """Get this thread's connection to the queue database."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, file_path TEXT NOT NULL, '
+                'fingerprint TEXT NOT NULL, size INTEGER NOT NULL, peer_ip TEXT NOT NULL, '
+                'hostname TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, '
+                'last_error TEXT)'
+            )
+            # Only one live job per file version and peer
+            conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS live_jobs ON jobs (file_path, fingerprint, peer_ip) '
+                "WHERE status IN ('pending', 'running')"
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS due_jobs ON jobs (status, next_attempt)')
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def start(self):
+        """Requeue jobs a previous run left half done and start the workers."""
+        conn = self.get_db()
+        with conn:
+            # In-memory files went with the previous run
+            lost = [
+                (time.time(), row['file_path']) for row in conn.execute(
+                    "SELECT DISTINCT file_path FROM jobs WHERE status IN ('pending', 'running') AND file_path LIKE ?",
+                    (MEMORY_PREFIX + '%',)
+                )
+                if row['file_path'] not in self.sources
+            ]
+            conn.executemany(
+                "UPDATE jobs SET status = 'removed', updated = ?, last_error = 'Upload was only kept in memory' "
+                "WHERE status IN ('pending', 'running') AND file_path = ?",
+                lost
+            )
+            conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        self.changed()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def enqueue(self, file_path, peers):
+        """Queue file_path for every peer (ip to hostname); returns how many jobs were new.
+
+        file_path may also be an in-memory source with a name and size, like
+        an upload or a batch of files, which is held by the queue until its
+        jobs are done.
+        """
+        if not isinstance(file_path, str):
+            source, size = file_path, file_path.size
+            file_path = f"{MEMORY_PREFIX}{uuid.uuid4().hex}/{source.name}"
+            fingerprint = f"{size}:memory"
+        else:
+            source = None
+            file_path = os.path.abspath(file_path)
+            stat = os.stat(file_path)
+            size, fingerprint = stat.st_size, f"{stat.st_size}:{stat.st_mtime_ns}"
+        now = time.time()
+        conn = self.get_db()
+        with self.sources_lock, conn:
+            if source is not None:
+                self.sources[file_path] = source
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO jobs (file_path, fingerprint, size, peer_ip, hostname, status, '
+                "next_attempt, created, updated) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                [(file_path, fingerprint, size, ip, hostname, now, now, now) for ip, hostname in peers.items()]
+            )
+            added = conn.total_changes - before
+        if added:
+            self.changed()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return added
+
+    def changed(self):
+        """Note that jobs changed, so the next list_jobs reads them again."""
+        with self.version_lock:
+            self.version += 1
+
+    def claim_batch(self):
+        """Mark the next due job, and every other due job for the same file, as running."""
+        order = 'size, id' if self.shortest_first else 'id'
+        now = time.time()
+        conn = self.get_db()
+        with self.claim_lock, conn:
+            first = conn.execute(
+                f"SELECT file_path, fingerprint FROM jobs WHERE status = 'pending' AND next_attempt <= ? "
+                f"ORDER BY {order} LIMIT 1",
+                (now,)
+            ).fetchone()
+            if first is None:
+                return []
+            jobs = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'pending' AND next_attempt <= ? "
+                'AND file_path = ? AND fingerprint = ?',
+                (now, first['file_path'], first['fingerprint'])
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ? WHERE id = ?",
+                [(now, job['id']) for job in jobs]
+            )
+        self.changed()
+        return [dict(job, attempts=job['attempts'] + 1) for job in jobs]
+
+    def work(self):
+        """Worker loop: send due batches, or wait for new or due jobs."""
+        while True:
+            try:
+                jobs = self.claim_batch()
+            except Exception as e:
+                logger.error(f"Error claiming queued transfers: {str(e)}")
+                jobs = []
+            if not jobs:
+                with self.wakeup:
+                    self.wakeup.wait(TRANSFER_POLL_INTERVAL)
+                continue
+            self.run_batch(jobs)
+            self.prune()
+
+    def run_batch(self, jobs):
+        """Send one file to the peers of a batch of jobs and record each outcome."""
+        file_path = jobs[0]['file_path']
+        by_ip = {job['peer_ip']: job for job in jobs}
+        results = {}
+        error = None
+        source = self.sources.get(file_path)
+        if file_path.startswith(MEMORY_PREFIX) and source is None:
+            error = 'Upload is no longer in memory'
+        elif source is None and not os.path.exists(file_path):
+            error = 'File no longer exists'
+        else:
+            def on_update(transfers):
+                for ip, transfer in transfers.items():
+                    if ip in by_ip:
+                        self.active[by_ip[ip]['id']] = transfer
+            try:
+                results = self.send_batch(file_path if source is None else source, {ip: job['hostname'] for ip, job in by_ip.items()}, on_update)
+            except Exception as e:
+                logger.error(f"Error sending queued transfer of {file_path}: {str(e)}")
+                error = str(e)
+
+        now = time.time()
+        updates = []
+        for ip, job in by_ip.items():
+            self.active.pop(job['id'], None)
+            status = results.get(ip, 'failed')
+            if error in ('File no longer exists', 'Upload is no longer in memory') or job['id'] in self.cancelled_jobs:
+                self.cancelled_jobs.discard(job['id'])
+                status, next_attempt = 'removed', now
+            elif status in RETRYABLE_STATUSES and job['attempts'] < TRANSFER_MAX_ATTEMPTS:
+                delay = min(TRANSFER_RETRY_BASE * 2 ** (job['attempts'] - 1), TRANSFER_RETRY_MAX)
+                logger.info(f"Send of {file_path} to {job['hostname']} {status}, retrying in {delay}s")
+                status, next_attempt = 'pending', now + delay
+            else:
+                status = status if status in FINAL_STATUSES else 'failed'
+                next_attempt = now
+            last_error = error or (results.get(ip, 'failed') if status != 'sent' else None)
+            updates.append((status, next_attempt, now, last_error, job['id']))
+        conn = self.get_db()
+        with conn:
+            conn.executemany(
+                'UPDATE jobs SET status = ?, next_attempt = ?, updated = ?, last_error = ? WHERE id = ?',
+                updates
+            )
+        self.changed()
+        self.release_sources()
+
+    def cancel(self, job_id):
+        """Drop a pending job, or stop a running one."""
+        transfer = self.active.get(job_id)
+        if transfer is not None:
+            self.cancelled_jobs.add(job_id)
+            transfer['cancelled'].set()
+        conn = self.get_db()
+        with conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'removed', updated = ?, last_error = NULL WHERE id = ? AND status = 'pending'",
+                (time.time(), job_id)
+            )
+        self.changed()
+        self.release_sources()
+
+    def release_sources(self):
+        """Let go of in-memory files no live job still needs."""
+        with self.sources_lock:
+            if not self.sources:
+                return
+            live = {
+                row['file_path'] for row in self.get_db().execute(
+                    "SELECT DISTINCT file_path FROM jobs WHERE status IN ('pending', 'running') AND file_path LIKE ?",
+                    (MEMORY_PREFIX + '%',)
+                )
+            }
+            for file_path in list(self.sources):
+                if file_path not in live:
+                    del self.sources[file_path]
+
+    def list_jobs(self, limit=50):
+        """Live jobs first, then the most recently finished ones.
+
+        The database is only read again after a job changed; progress of
+        running jobs comes from memory.
+        """
+        version = self.version
+        listed = self.listed
+        if listed is not None and listed[:2] == (version, limit):
+            rows = listed[2]
+        else:
+            rows = self.get_db().execute(
+                "SELECT * FROM jobs ORDER BY status NOT IN ('pending', 'running'), updated DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+            self.listed = (version, limit, rows)
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            transfer = self.active.get(job['id'])
+            if transfer is not None:
+                job['progress'] = min(transfer['sent'] / transfer['total'], 1.0) if transfer['total'] else 0.0
+                job['transfer_status'] = transfer['status']
+            jobs.append(job)
+        return jobs
+
+    def prune(self):
+        """Forget all but the most recent finished jobs."""
+        conn = self.get_db()
+        with conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status NOT IN ('pending', 'running') AND id NOT IN ("
+                "SELECT id FROM jobs WHERE status NOT IN ('pending', 'running') ORDER BY updated DESC LIMIT ?)",
+                (TRANSFER_HISTORY,)
+            )